@@ -0,0 +1,278 @@
+"""Нагрузочный тест бота на поддельном Telegram Bot API.
+
+Поднимает локальный aiohttp-сервер вместо api.telegram.org (с настраиваемой задержкой и
+случайными ответами 429), прогоняет через dp синтетические апдейты и печатает задержку
+обработчиков (p50/p95/p99), апдейты в секунду и число SQLite-операций на апдейт.
+
+Запуск: python benchmark.py --users 200 --latency 0.03 --flood-rate 0.01
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+import main
+
+BENCH_ADMIN_ID = 1
+BENCH_CHANNEL_ID = -1001000000000
+BENCH_ADMIN_USERNAME = main.SUPER_ADMIN_USERNAME  # Получает права супер-админа в add_user
+
+
+# === ПОДДЕЛЬНЫЙ BOT API ===
+class FakeTelegramAPI:
+    """Отвечает на методы Bot API как настоящий сервер, но без сети и без Telegram."""
+
+    def __init__(self, latency: float, flood_rate: float, retry_after: int):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.floods = 0
+        self._message_ids = itertools.count(1000)
+
+    def _message(self, chat_id, text=None) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            "text": text,
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await request.post()
+        self.calls[method] += 1
+
+        if self.latency:
+            await asyncio.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+
+        if method not in ("getMe", "setMyCommands", "deleteWebhook") and random.random() < self.flood_rate:
+            self.floods += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    def _result(self, method: str, params):
+        if method == "getMe":
+            return {"id": main.bot.id, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getChatMember":
+            user_id = int(params.get("user_id", 0))
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "U"}}
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        if method == "sendMediaGroup":
+            chat_id = params.get("chat_id")
+            return [self._message(chat_id) for _ in json.loads(params.get("media", "[]"))]
+        if method.startswith("send"):
+            return self._message(params.get("chat_id"), params.get("text"))
+        return True  # editMessage*, answerCallbackQuery, setMyCommands, deleteMessage и т.д.
+
+
+# === СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ===
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        username = BENCH_ADMIN_USERNAME if user_id == BENCH_ADMIN_ID else f"user{user_id}"
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": username}
+
+    def message(self, user_id: int, text: str) -> Update:
+        data = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            data["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.model_validate({"update_id": next(self._update_ids), "message": data},
+                                     context={"bot": main.bot})
+
+    def callback(self, user_id: int, data: str, message_id: int = 1) -> Update:
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": main.bot.id, "is_bot": True, "first_name": "Bench"},
+            "text": "...",
+        }
+        query = {"id": str(next(self._update_ids)), "from": self._user(user_id), "chat_instance": "bench",
+                 "data": data, "message": message}
+        return Update.model_validate({"update_id": next(self._update_ids), "callback_query": query},
+                                     context={"bot": main.bot})
+
+
+# === ИЗМЕРЕНИЯ ===
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)  # сценарий -> секунды
+        self.errors = Counter()  # Исключения, вылетевшие из обработчиков
+        self.sql_ops = 0
+
+    def trace(self, _statement: str):
+        self.sql_ops += 1  # Вызывается из потока aiosqlite на каждый SQL-оператор
+
+    async def feed(self, label: str, update: Update):
+        started = time.perf_counter()
+        try:
+            await main.dp.feed_update(main.bot, update)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+        self.latencies[label].append(time.perf_counter() - started)
+
+    @property
+    def updates(self) -> int:
+        return sum(len(v) for v in self.latencies.values())
+
+
+def percentile(values: list, p: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def print_report(recorder: Recorder, api: FakeTelegramAPI, wall: float, broadcast: tuple):
+    print(f"\n{'Сценарий':<18}{'N':>7}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    every = []
+    for label, values in recorder.latencies.items():
+        every.extend(values)
+        print(f"{label:<18}{len(values):>7}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}")
+    print(f"{'всего':<18}{len(every):>7}"
+          f"{percentile(every, 50) * 1000:>10.1f}{percentile(every, 95) * 1000:>10.1f}"
+          f"{percentile(every, 99) * 1000:>10.1f}")
+
+    print(f"\nАпдейтов в секунду: {recorder.updates / wall:.1f} ({recorder.updates} за {wall:.2f} сек.)")
+    print(f"SQLite-операций на апдейт: {recorder.sql_ops / max(recorder.updates, 1):.1f}")
+    print(f"Рассылка: {broadcast[0]} получателей за {broadcast[1]:.2f} сек. "
+          f"({broadcast[0] / broadcast[1] if broadcast[1] else 0:.1f} сообщ./сек)")
+    print(f"Вызовы Bot API: {dict(api.calls)}; ответов 429: {api.floods}")
+    if recorder.errors:
+        print(f"Ошибки в обработчиках: {dict(recorder.errors)}")
+
+
+# === СЦЕНАРИИ ===
+async def run_user(factory: UpdateFactory, recorder: Recorder, user_id: int, code: str):
+    """Deep link -> шаблон -> текст: полный путь SendingFlow для одного отправителя."""
+    await recorder.feed("start_deeplink", factory.message(user_id, f"/start {code}"))
+    await recorder.feed("template", factory.callback(user_id, "tpl_custom"))
+    await recorder.feed("send", factory.message(user_id, f"Привет от {user_id}"))
+
+
+async def wait_deliveries():
+    """Ждёт, пока очередь доставки отправит всё, что в ней есть."""
+    while len(main.delivery_queue) or main.delivery_queue._tasks:
+        await asyncio.sleep(0.01)
+
+
+async def run(args):
+    api = FakeTelegramAPI(args.latency, args.flood_rate, args.retry_after)
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.port).start()
+
+    main.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.port}"))
+    if args.rate:
+        main.telegram_limiter = main.TelegramRateLimiter(args.rate, main.TELEGRAM_PER_CHAT_INTERVAL)
+
+    db_dir = tempfile.TemporaryDirectory(prefix="anonmsg-bench-")
+    main.db.db_name = os.path.join(db_dir.name, "bench.db")
+    await main.db.connect()
+    await main.db.create_tables()
+    await main.db.load_recipients()
+    # Обязательные каналы — чтобы каждый апдейт проходил проверку подписки (getChatMember)
+    for i in range(args.channels):
+        await main.db.add_channel(BENCH_CHANNEL_ID - i, f"Bench {i + 1}", f"https://t.me/+bench{i + 1}")
+    if isinstance(main.storage, main.SQLiteStorage):
+        main.storage.start()
+    await main.bot_identity.refresh()
+    main.dp["bot_identity"] = main.bot_identity
+
+    recorder = Recorder()
+    for conn in [main.db._writer, *main.db._readers._queue]:
+        await conn.set_trace_callback(recorder.trace)
+
+    factory = UpdateFactory()
+    delivery = asyncio.create_task(main.delivery_task())
+    try:
+        # Владельцы ящиков и админ
+        recipients = list(range(10_000, 10_000 + args.recipients))
+        await recorder.feed("start", factory.message(BENCH_ADMIN_ID, "/start"))
+        await asyncio.gather(*(recorder.feed("start", factory.message(uid, "/start")) for uid in recipients))
+        codes = [await main.db.get_user_code(uid) for uid in recipients]
+
+        # Отправители: все одновременно, каждый по своему сценарию
+        senders = range(20_000, 20_000 + args.users)
+        started = time.perf_counter()
+        await asyncio.gather(*(run_user(factory, recorder, uid, random.choice(codes)) for uid in senders))
+        await wait_deliveries()
+
+        # Раскрытия админом
+        await main.db.flush_writes()
+        async with main.db._read() as conn:
+            async with conn.execute("SELECT msg_id FROM messages LIMIT ?", (args.reveals,)) as cursor:
+                msg_ids = [row[0] for row in await cursor.fetchall()]
+        await asyncio.gather(*(recorder.feed("reveal", factory.callback(BENCH_ADMIN_ID, f"reveal_{msg_id}"))
+                               for msg_id in msg_ids for _ in range(args.reveal_clicks)))
+        wall = time.perf_counter() - started
+
+        # Рассылка на всех зарегистрированных
+        await recorder.feed("broadcast_cmd", factory.callback(BENCH_ADMIN_ID, "adm_broadcast"))
+        broadcast_started = time.perf_counter()
+        await recorder.feed("broadcast_cmd", factory.message(BENCH_ADMIN_ID, "Новости бенчмарка"))
+        await asyncio.gather(*main.active_broadcasts)
+        audience = 1 + args.recipients + args.users
+        broadcast = (audience, time.perf_counter() - broadcast_started)
+
+        print_report(recorder, api, wall, broadcast)
+    finally:
+        delivery.cancel()
+        await main.storage.close()
+        await main.db.close()
+        db_dir.cleanup()
+        await main.bot.session.close()
+        await runner.cleanup()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200, help="отправителей (каждый проходит SendingFlow)")
+    parser.add_argument("--recipients", type=int, default=20, help="владельцев ящиков")
+    parser.add_argument("--reveals", type=int, default=50, help="раскрытий админом")
+    parser.add_argument("--channels", type=int, default=1, help="обязательных каналов для подписки")
+    parser.add_argument("--reveal-clicks", type=int, default=1, help="одновременных нажатий на каждое сообщение")
+    parser.add_argument("--latency", type=float, default=0.03, help="средняя задержка ответа API, сек.")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429")
+    parser.add_argument("--rate", type=float, default=0, help="заменить TELEGRAM_GLOBAL_RATE (0 — как в боте)")
+    parser.add_argument("--port", type=int, default=8081)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    asyncio.run(run(parse_args()))
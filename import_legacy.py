@@ -0,0 +1,275 @@
+"""Перенос старого bot_data.json в SQLite.
+
+Файл читается потоково: в памяти одновременно находится только одна запись секции, поэтому
+многогигабайтные дампы переносятся с ограниченным расходом памяти. Записи пишутся пачками
+через executemany, каждая пачка — одна транзакция. Повторный запуск безопасен: INSERT OR IGNORE
+не трогает уже существующие строки (в том числе изменённые ботом после прошлого импорта).
+
+Запуск: python import_legacy.py bot_data.json --db bot.db
+"""
+import argparse
+import asyncio
+import json
+import logging
+import re
+import time
+from datetime import datetime
+
+import main
+
+IMPORT_BATCH_SIZE = 10000  # Строк в одной транзакции
+READ_CHUNK_SIZE = 1 << 20  # Сколько символов читать из файла за раз
+PROGRESS_INTERVAL = 5  # Как часто (сек.) печатать прогресс
+
+MEDIA_TYPES = ("photo", "video", "voice", "audio", "animation", "sticker", "document", "video_note")
+
+
+# === ПОТОКОВЫЙ РАЗБОР JSON ===
+class JsonStream:
+    """Читает JSON-документ кусками и разбирает его по одному значению (json.JSONDecoder.raw_decode).
+
+    Объекты верхних уровней обходятся через keys(): ключ возвращается сразу, а значение вызывающий
+    читает сам — целиком через value() или снова по ключам через keys().
+    """
+
+    _whitespace = re.compile(r"\s*")
+    _number_tail = re.compile(r"[0-9.eE+-]*")
+
+    def __init__(self, f, chunk_size: int = READ_CHUNK_SIZE):
+        self._file = f
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        chunk = self._file.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        while True:
+            self._pos = self._whitespace.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, char: str):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r}, got {found or 'end of file'!r}")
+        self._pos += 1
+
+    def value(self):
+        """Разбирает следующее значение целиком."""
+        self._peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if self._eof or not self._fill():
+                    raise
+                continue
+            # Число на границе куска могло быть прочитано не полностью: "12" из "123", "-1" из "-1.5e3"
+            if (isinstance(obj, (int, float)) and not self._eof
+                    and self._number_tail.match(self._buf, end).end() == len(self._buf) and self._fill()):
+                continue
+            self._pos = end
+            return obj
+
+    def keys(self):
+        """Итерирует ключи объекта; значение каждого ключа нужно прочитать до следующей итерации."""
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(":")
+            yield key
+            separator = self._peek()
+            self._pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"Expected ',' or '}}', got {separator or 'end of file'!r}")
+
+    def items(self):
+        for key in self.keys():
+            yield key, self.value()
+
+
+# === ПРЕОБРАЗОВАНИЕ ЗАПИСЕЙ ===
+def map_user(user_id: str, data: dict, now: str) -> tuple:
+    return (
+        int(user_id), data.get("username"), data.get("full_name") or data.get("first_name"),
+        int(bool(data.get("is_admin"))), int(bool(data.get("is_super_admin"))), int(bool(data.get("is_special"))),
+        data.get("sub_expiry"), int(bool(data.get("blocked_bot"))), int(bool(data.get("banned"))),
+        data.get("reg_date") or now,
+    )
+
+
+def map_message(msg_id: str, data: dict) -> tuple:
+    content = data.get("content") or {}
+    content_type = data.get("content_type") or "text"
+    file_id = data.get("file_id")
+    if file_id is None and content_type in MEDIA_TYPES:
+        media = content.get(content_type)
+        if isinstance(media, list) and media:  # photo: размеры по возрастанию, берём самый большой
+            media = media[-1]
+        if isinstance(media, dict):
+            file_id = media.get("file_id")
+    return (
+        data.get("msg_id") or msg_id, data.get("from_user_id"), data.get("to_user_id"), content_type,
+        data.get("content_text", content.get("text")), file_id, data.get("caption", content.get("caption")),
+        int(bool(data.get("revealed"))), data.get("sent_at"), data.get("scheduled_time"),
+        data.get("tg_message_id") or 0,
+    )
+
+
+def map_channel(channel_id: str, data) -> tuple:
+    if isinstance(data, dict):
+        return int(channel_id), data.get("title"), data.get("invite_link") or data.get("link") or data.get("url")
+    return int(channel_id), None, data  # Старый формат: {channel_id: ссылка}
+
+
+# === ИМПОРТ ===
+class LegacyImporter:
+    """Раскладывает секции bot_data.json по таблицам users, recipients, messages и channels."""
+
+    # Пользователи, известные только по recipients/messages, складываются в промежуточную таблицу
+    # и добавляются в users в конце — чтобы не перекрыть полные записи из секции users
+    STUBS_TABLE = "legacy_user_stubs"
+
+    SQL = {
+        "users": """
+            INSERT OR IGNORE INTO users (user_id, username, full_name, is_admin, is_super_admin, is_special,
+                                         sub_expiry, blocked_bot, banned, reg_date)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        "recipients": "INSERT OR IGNORE INTO recipients (user_id, code) VALUES (?, ?)",
+        "messages": """
+            INSERT OR IGNORE INTO messages (msg_id, from_user_id, to_user_id, content_type, content_text, file_id,
+                                            caption, revealed, sent_at, scheduled_time, tg_message_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        "channels": "INSERT OR IGNORE INTO channels (channel_id, title, invite_link) VALUES (?, ?, ?)",
+        "stubs": f"INSERT OR IGNORE INTO {STUBS_TABLE} (user_id, username, full_name) VALUES (?, ?, ?)",
+    }
+
+    def __init__(self, database: main.Database, batch_size: int = IMPORT_BATCH_SIZE):
+        self.db = database
+        self.batch_size = batch_size
+        self.now = datetime.now().isoformat()
+        self.read = {}  # таблица -> прочитано записей
+        self.inserted = {}  # таблица -> добавлено строк
+        self._batches = {}  # таблица -> накопленные строки
+        self._started = time.perf_counter()
+        self._last_progress = self._started
+
+    async def add(self, table: str, row: tuple):
+        batch = self._batches.setdefault(table, [])
+        batch.append(row)
+        self.read[table] = self.read.get(table, 0) + 1
+        if len(batch) >= self.batch_size:
+            await self._flush(table)
+
+    async def _flush(self, table: str):
+        batch = self._batches.get(table)
+        if not batch:
+            return
+        async with self.db._write() as conn:
+            cursor = await conn.executemany(self.SQL[table], batch)
+            self.inserted[table] = self.inserted.get(table, 0) + max(cursor.rowcount, 0)
+        batch.clear()
+
+        now = time.perf_counter()
+        if now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            total = sum(self.read.values())
+            logging.info(f"{total} records read ({total / (now - self._started):.0f} rows/sec)")
+
+    async def flush_all(self):
+        for table in list(self._batches):
+            await self._flush(table)
+
+    async def run(self, f):
+        async with self.db._write() as conn:
+            await conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.STUBS_TABLE} (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    full_name TEXT
+                )
+            """)
+
+        stream = JsonStream(f)
+        for section in stream.keys():
+            if section == "users":
+                for user_id, data in stream.items():
+                    await self.add("users", map_user(user_id, data, self.now))
+            elif section == "recipients":
+                for user_id, data in stream.items():
+                    await self.add("recipients", (int(user_id), data["code"]))
+                    await self.add("stubs", (int(user_id), data.get("username"), data.get("first_name")))
+            elif section == "messages":
+                for msg_id, data in stream.items():
+                    await self.add("messages", map_message(msg_id, data))
+                    if data.get("from_user_id"):
+                        await self.add("stubs", (data["from_user_id"], data.get("from_username"),
+                                                 data.get("from_first_name")))
+            elif section == "required_channels":
+                for channel_id, data in stream.items():
+                    await self.add("channels", map_channel(channel_id, data))
+            else:
+                logging.warning(f"Unknown section {section!r} skipped")
+                stream.value()
+        await self.flush_all()
+
+        async with self.db._write() as conn:
+            cursor = await conn.execute(f"""
+                INSERT OR IGNORE INTO users (user_id, username, full_name, reg_date)
+                SELECT user_id, username, full_name, ? FROM {self.STUBS_TABLE}
+            """, (self.now,))
+            self.inserted["users"] = self.inserted.get("users", 0) + max(cursor.rowcount, 0)
+            await conn.execute(f"DROP TABLE {self.STUBS_TABLE}")
+
+    def report(self):
+        elapsed = time.perf_counter() - self._started
+        total = 0
+        print(f"\n{'Таблица':<12}{'прочитано':>12}{'добавлено':>12}")
+        for table in ("users", "recipients", "messages", "channels"):
+            total += self.read.get(table, 0)
+            print(f"{table:<12}{self.read.get(table, 0):>12}{self.inserted.get(table, 0):>12}")
+        print(f"\nЗаписей: {total} за {elapsed:.2f} сек. ({total / elapsed if elapsed else 0:.0f} строк/сек)")
+
+
+async def run(args):
+    database = main.Database(args.db, readers=1)
+    await database.connect()
+    try:
+        await database.create_tables()
+        importer = LegacyImporter(database, args.batch_size)
+        with open(args.path, encoding="utf-8") as f:
+            await importer.run(f)
+        importer.report()
+    finally:
+        await database.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", nargs="?", default="bot_data.json", help="старый JSON-дамп бота")
+    parser.add_argument("--db", default=main.DB_NAME, help="файл SQLite (по умолчанию DB_NAME бота)")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="строк в одной транзакции")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
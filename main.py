@@ -1,25 +1,44 @@
 import asyncio
+import cProfile
+import heapq
+import inspect
+import json
 import logging
+import multiprocessing
 import secrets
+import signal
 import string
+import time
+import traceback
 import os
 import re
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, suppress
 from datetime import datetime, timedelta
-from typing import Optional, Union
+from functools import lru_cache
+from typing import Any, Dict, Mapping, Optional, Union
 
 import aiosqlite
-from aiogram import Bot, Dispatcher, Router, F
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+from aiosqlite.context import contextmanager as aiosqlite_result
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F, html
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.client.default import DefaultBotProperties
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup,
-    BotCommand, ContentType
+    BotCommand, ContentType, User
 )
-from aiogram.filters import Command, CommandStart, CommandObject
+from aiogram.filters import BaseFilter, Command, CommandStart, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.utils.media_group import MediaGroupBuilder
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
 
 # === КОНФИГУРАЦИЯ ===
 # !!! Введите свой реальный BOT_TOKEN !!!
@@ -27,6 +46,24 @@ BOT_TOKEN = "8562053785:AAG0TGlwwIY_dly-Wo7CzTf2F0GmR6A46Wg"
 PROVIDER_TOKEN = ""
 USE_PAYMENTS = False
 DB_NAME = "bot.db"
+DB_READERS = 4  # Размер пула соединений для чтения
+DB_CACHE_SIZE_KB = 16384  # Кэш страниц SQLite на соединение
+DB_BUSY_TIMEOUT_MS = 5000
+USER_CACHE_SIZE = 10000  # Сколько записей users держать в памяти
+USER_CACHE_TTL = 60  # Время жизни записи в кэше, сек.
+SUBSCRIPTION_CACHE_SIZE = 50000
+SUBSCRIPTION_CACHE_TTL = 600  # Сколько секунд доверять положительной проверке подписки на канал
+WRITE_BATCH_DELAY = 0.005  # Сколько секунд копить фоновые записи перед общей транзакцией
+WRITE_BATCH_SIZE = 500  # Максимум операций в одной транзакции
+DB_CHECK_QUERY_PLANS = False  # Проверять каждый запрос через EXPLAIN QUERY PLAN и логировать полные сканы
+
+# Обслуживание БД: раз в сутки старые доставленные сообщения переносятся в архив, затем освобождается место
+ARCHIVE_AFTER_DAYS = 30  # Сообщения старше стольких дней уходят в архив; 0 — не архивировать
+ARCHIVE_DB_NAME = ""  # Файл для архива (подключается через ATTACH); пусто — таблица messages_archive в DB_NAME
+ARCHIVE_BATCH_SIZE = 500  # Сообщений за одну транзакцию переноса
+MAINTENANCE_HOUR = 4  # Час (по локальному времени) запуска обслуживания
+MAINTENANCE_DRY_RUN = False  # Только логировать отчёт, ничего не переносить и не сжимать
+VACUUM_STEP_PAGES = 1000  # Страниц за один шаг incremental_vacuum
 # !!! Введите свой реальный username для Супер-Админа !!!
 SUPER_ADMIN_USERNAME = "fenixkeeper"
 # !!! ID/USERNAME Супер-Админа для ссылки на раскрытие !!!
@@ -36,29 +73,361 @@ SUPER_ADMIN_ID_FOR_LINK = "fenixkeeper"
 DAILY_MESSAGE_LIMIT = 5  # Базовый лимит
 SPECIAL_MESSAGE_LIMIT = 20  # Лимит для статуса "Особый"
 
+# Хранилище состояний FSM: "sqlite" (таблица в DB_NAME), "redis" (нужен пакет redis) или "memory"
+FSM_STORAGE = "sqlite"
+REDIS_URL = "redis://localhost:6379/0"
+FSM_STATE_TTL = 24 * 3600  # Через сколько секунд без изменений состояние считается брошенным
+FSM_FLUSH_INTERVAL = 0.2  # Как часто (сек.) записывать накопленные изменения состояний
+FSM_FLUSH_BATCH = 500  # Записать сразу, если накопилось столько изменённых ключей
+FSM_CLEANUP_INTERVAL = 3600  # Как часто удалять брошенные состояния
+
+# Режим приёма апдейтов: long polling (по умолчанию) или вебхук на aiohttp
+USE_WEBHOOK = False
+WEBHOOK_URL = ""  # Публичный https-адрес бота, например "https://bot.example.com"; пусто — только локальный сервер
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""  # Секрет для X-Telegram-Bot-Api-Secret-Token; пусто — сгенерировать при старте
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_SHUTDOWN_TIMEOUT = 30  # Сколько секунд ждать незавершённые апдейты при остановке
+MAX_CONCURRENT_UPDATES = 100  # Апдейтов, обрабатываемых одновременно
+# Шардированный режим: супервизор принимает апдейты и раздаёт их SHARD_WORKERS процессам по from_user.id,
+# планировщик и рассылки работают в отдельном сервисном процессе. 0 — всё в одном процессе
+SHARD_WORKERS = 0
+SHARD_SHUTDOWN_TIMEOUT = 30  # Сколько секунд ждать остановки воркеров
+SHARD_WATCH_INTERVAL = 5  # Как часто (сек.) супервизор проверяет воркеры и перезапускает упавшие
+
+# Метрики в формате Prometheus на /metrics и разбор медленных апдейтов
+METRICS_ENABLED = False
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100  # Если совпадает с WEBHOOK_PORT, /metrics отдаёт сервер вебхука; воркеры — METRICS_PORT + 1 + номер
+SLOW_UPDATE_THRESHOLD = 2.0  # Апдейт дольше стольких секунд считается медленным; 0 — не отслеживать
+SLOW_UPDATE_PROFILE = ""  # "stack" — логировать стек задачи, "cprofile" — сохранять .prof в PROFILE_DIR; пусто — выкл.
+SLOW_UPDATE_MAX_SAMPLES = 5  # Сколько раз логировать стек одного зависшего апдейта
+PROFILE_DIR = "profiles"
+
+BOT_INFO_REFRESH_INTERVAL = 3600  # Как часто (сек.) перечитывать getMe
+BOT_INFO_STARTUP_ATTEMPTS = 5  # Попыток getMe при старте (сетевые ошибки и 5xx); пауза удваивается с 1 сек.
+
+SCHEDULER_WORKERS = 10  # Параллельных передач наступивших отложенных сообщений в очередь доставки
+
+# Очередь доставки: обработчик только сохраняет сообщение в таблицу deliveries, отправляют фоновые воркеры
+DELIVERY_WORKERS = 20  # Параллельных доставок
+DELIVERY_MAX_ATTEMPTS = 5  # После стольких неудач сообщение уходит в dead_letters
+DELIVERY_RETRY_DELAY = 5  # Первая пауза перед повтором, сек.; дальше удваивается
+DELIVERY_MAX_RETRY_DELAY = 300
+
+# Лимиты Telegram Bot API: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+TELEGRAM_GLOBAL_RATE = 25
+TELEGRAM_PER_CHAT_INTERVAL = 1.0
+RATE_LIMIT_MAX_TRACKED_CHATS = 10000
+
+BROADCAST_WORKERS = 20  # Параллельных отправок при рассылке
+BROADCAST_BATCH_SIZE = 500  # Получателей в пачке; после каждой пачки сохраняется курсор
+BROADCAST_MAX_ATTEMPTS = 3  # Попыток на получателя (RetryAfter и сетевые ошибки)
+BROADCAST_PROGRESS_INTERVAL = 5  # Как часто (сек.) обновлять прогресс у админа
+BROADCAST_ERRORS_IN_REPORT = 5  # Сколько самых частых ошибок показать админу в итоге рассылки
+BROADCAST_MAX_ERROR_KINDS = 100  # Сколько разных текстов ошибок хранить; остальные считаются вместе
+
 SUPPORTED_CONTENT_TYPES = [
     ContentType.TEXT, ContentType.PHOTO, ContentType.VIDEO,
     ContentType.VOICE, ContentType.AUDIO, ContentType.ANIMATION, ContentType.STICKER
 ]
+# Альбом хранится как одно сообщение с content_type = MEDIA_GROUP и списком файлов в колонке media
+MEDIA_GROUP = "media_group"
+ALBUM_CONTENT_TYPES = [ContentType.PHOTO, ContentType.VIDEO, ContentType.AUDIO]
+MEDIA_GROUP_WINDOW = 0.5  # Сколько секунд ждать следующую часть альбома
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 default_properties = DefaultBotProperties(parse_mode=ParseMode.HTML)
 bot = Bot(token=BOT_TOKEN, default=default_properties)
 
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
 router = Router()
-dp.include_router(router)
 
 
 # === КЛАСС РАБОТЫ С БД ===
+USER_COLUMNS = {
+    "user_id", "username", "full_name", "is_admin", "is_super_admin", "is_special", "sub_expiry",
+    "blocked_bot", "banned", "reg_date", "messages_sent_today", "last_message_date"
+}
+MESSAGE_COLUMNS = (
+    "msg_id, from_user_id, to_user_id, content_type, content_text, file_id, caption, revealed, sent_at, "
+    "scheduled_time, tg_message_id, send_attempts, media"
+)
+
+
+class TTLCache:
+    """Ограниченный LRU-кэш с временем жизни записей.
+
+    version растёт при каждом удалении: чтение, начатое до инвалидации, не сможет положить в кэш
+    устаревшие данные (set с old version игнорируется).
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, version: Optional[int] = None):
+        if version is not None and version != self.version:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self.version += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.version += 1
+        self._data.clear()
+
+
+class RecipientDirectory:
+    """Все коды ящиков в памяти: code -> user_id и user_id -> code.
+
+    Загружается при старте (Database.load_recipients) и пополняется при создании ящика, поэтому
+    неверный код отклоняется без запроса к БД, а новый код проверяется на занятость здесь же.
+    """
+
+    def __init__(self):
+        self.by_code: dict = {}
+        self.by_user: dict = {}
+
+    def __len__(self):
+        return len(self.by_code)
+
+    def add(self, user_id: int, code: str):
+        self.by_code[code] = user_id
+        self.by_user[user_id] = code
+
+
+class QueryPlanChecker:
+    """Обёртка над соединением: перед каждым запросом выполняет EXPLAIN QUERY PLAN и ищет полные сканы."""
+
+    CHECKED_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+    def __init__(self, conn: aiosqlite.Connection, query_plans: dict):
+        self._conn = conn
+        self._query_plans = query_plans
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def explain(self, sql: str, parameters=None) -> list:
+        """Возвращает строки плана запроса (колонка detail)."""
+        async with self._conn.execute(f"EXPLAIN QUERY PLAN {sql}", parameters or []) as cursor:
+            return [row[3] for row in await cursor.fetchall()]
+
+    @staticmethod
+    def full_scans(plan: list) -> list:
+        """Строки плана со сканом таблицы. Скан подзапроса из FROM (CO-ROUTINE/MATERIALIZE) не считается:
+        его размер ограничивает сам подзапрос, а таблицы внутри него проверяются своими строками плана."""
+        subqueries = {d.split(" ", 1)[1] for d in plan if d.startswith(("CO-ROUTINE ", "MATERIALIZE "))}
+        scans = []
+        for d in plan:
+            if not d.startswith("SCAN ") or d.startswith("SCAN CONSTANT ROW"):
+                continue
+            if d.split(" ")[1] not in subqueries:
+                scans.append(d)
+        return scans
+
+    async def _check(self, sql: str, parameters):
+        statement = " ".join(sql.split())
+        if statement.upper().startswith(self.CHECKED_STATEMENTS) and statement not in self._query_plans:
+            scans = self.full_scans(await self.explain(sql, parameters))
+            self._query_plans[statement] = scans
+            if scans:
+                logging.warning(f"Full scan in query: {statement} -> {'; '.join(scans)}")
+
+    @aiosqlite_result
+    async def execute(self, sql: str, parameters=None):
+        await self._check(sql, parameters)
+        return await self._conn.execute(sql, parameters)
+
+    @aiosqlite_result
+    async def executemany(self, sql: str, parameters):
+        parameters = list(parameters)
+        if parameters:
+            await self._check(sql, parameters[0])  # План одинаков для всех наборов параметров
+        return await self._conn.executemany(sql, parameters)
+
+
 class Database:
-    def __init__(self, db_name):
+    """Работа с SQLite через постоянные соединения: один писатель и пул читателей (WAL)."""
+
+    def __init__(self, db_name, readers: int = DB_READERS):
         self.db_name = db_name
+        self.readers_count = readers
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: Optional[asyncio.Queue] = None
+        self._write_lock = asyncio.Lock()
+        self._write_queue: Optional[asyncio.Queue] = None  # (sql, params, future, fetch) для пакетной записи
+        self._write_task: Optional[asyncio.Task] = None
+        self.check_query_plans = DB_CHECK_QUERY_PLANS
+        self.query_plans: dict = {}  # Проверенный запрос -> строки плана с полным сканом (пусто, если их нет)
+        self.user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        self._channels: Optional[list] = None
+        self._channels_loaded_at = 0.0
+        self.channels_ttl: Optional[float] = None  # В шардированном режиме список меняют и другие процессы
+        self.archive = "archive.messages_archive" if ARCHIVE_DB_NAME else "messages_archive"
+        self.recipients: Optional[RecipientDirectory] = None  # None — коды читаются из БД
+        # False в шардированном режиме: ящики создают и другие процессы, промах проверяется по БД
+        self.recipients_complete = True
+
+    async def _open(self, readonly: bool = False) -> aiosqlite.Connection:
+        new_db = not readonly and not os.path.exists(self.db_name)
+        conn = await aiosqlite.connect(self.db_name)
+        conn.row_factory = aiosqlite.Row
+        if new_db:
+            # Режим задаётся до переключения в WAL: оно записывает заголовок файла, и менять auto_vacuum уже поздно
+            await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        await conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        await conn.execute("PRAGMA temp_store=MEMORY")
+        await conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        if ARCHIVE_DB_NAME:
+            new_archive = not readonly and not os.path.exists(ARCHIVE_DB_NAME)
+            await conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_NAME,))
+            if new_archive:
+                await conn.execute("PRAGMA archive.auto_vacuum=INCREMENTAL")
+            if not readonly:
+                async with conn.execute("PRAGMA archive.journal_mode=WAL"):
+                    pass  # Курсор закрывается сразу, иначе незавершённый оператор держит блокировку архива
+        if readonly:
+            await conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def connect(self):
+        """Открывает соединения. Вызывается один раз при старте бота."""
+        if self._writer is not None:
+            return
+        self._writer = await self._open()
+        self._readers = asyncio.Queue()
+        for _ in range(self.readers_count):
+            self._readers.put_nowait(await self._open(readonly=True))
+        self._write_queue = asyncio.Queue()
+        self._write_task = asyncio.create_task(self._write_behind_loop())
+
+    async def close(self):
+        """Записывает очередь отложенных записей и закрывает все соединения (при остановке бота)."""
+        if self._writer is None:
+            return
+        self._write_queue.put_nowait(None)
+        await self._write_task
+        async with self._write_lock:
+            while not self._readers.empty():
+                await self._readers.get_nowait().close()
+            await self._writer.close()
+            self._writer = None
+            self._readers = None
+
+    def _wrap(self, conn: aiosqlite.Connection):
+        return QueryPlanChecker(conn, self.query_plans) if self.check_query_plans else conn
+
+    def get_full_scans(self) -> dict:
+        """Запросы, выполненные с полным сканом таблицы (при включённой проверке планов)."""
+        return {sql: plan for sql, plan in self.query_plans.items() if plan}
+
+    @asynccontextmanager
+    async def _read(self):
+        """Берёт соединение-читатель из пула на время запроса."""
+        conn = await self._readers.get()
+        try:
+            yield self._wrap(conn)
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self):
+        """Эксклюзивный доступ к соединению-писателю: commit при успехе, rollback при ошибке."""
+        async with self._write_lock:
+            try:
+                yield self._wrap(self._writer)
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            await self._writer.commit()
+
+    def _enqueue(self, sql: str, params, fetch: bool = False, wait: bool = False) -> Optional[asyncio.Future]:
+        """Ставит запрос в очередь пакетной записи.
+
+        Без wait запись фоновая (ошибки только логируются); с wait возвращается future, который
+        завершится после commit пачки: строкой RETURNING при fetch, иначе числом изменённых строк.
+        """
+        future = asyncio.get_running_loop().create_future() if wait else None
+        self._write_queue.put_nowait((sql, params, future, fetch))
+        return future
+
+    async def _write_behind_loop(self):
+        """Собирает накопившиеся записи в одну транзакцию (group commit)."""
+        stopping = False
+        while not stopping:
+            op = await self._write_queue.get()
+            if op is None:
+                break
+            if WRITE_BATCH_DELAY and self._write_queue.qsize() < WRITE_BATCH_SIZE:
+                await asyncio.sleep(WRITE_BATCH_DELAY)
+
+            batch = [op]
+            while len(batch) < WRITE_BATCH_SIZE and not self._write_queue.empty():
+                op = self._write_queue.get_nowait()
+                if op is None:
+                    stopping = True
+                    break
+                batch.append(op)
+            await self._apply_write_batch(batch)
+
+    async def _apply_write_batch(self, batch: list):
+        results = []
+        try:
+            async with self._write() as db:
+                await db.execute("BEGIN IMMEDIATE")  # Сразу берём блокировку записи: её ждут и другие процессы
+                for sql, params, future, fetch in batch:
+                    # Savepoint на каждую операцию: ошибка одной не откатывает остальные
+                    await db.execute("SAVEPOINT write_op")
+                    try:
+                        async with db.execute(sql, params) as cursor:
+                            result = (await cursor.fetchall() or [None])[0] if fetch else cursor.rowcount
+                        results.append((future, result, None))
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO write_op")
+                        results.append((future, None, e))
+                    await db.execute("RELEASE write_op")
+        except Exception as e:
+            logging.error(f"Write batch of {len(batch)} failed: {e}")
+            results = [(future, None, e) for _, _, future, _ in batch]
+
+        for future, result, error in results:
+            if future is None:
+                if error:
+                    logging.error(f"Background write failed: {error}")
+            elif not future.done():
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
 
     async def create_tables(self):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
@@ -94,7 +463,9 @@ class Database:
                     revealed BOOLEAN DEFAULT 0,
                     sent_at TEXT,
                     scheduled_time TEXT NULL, 
-                    tg_message_id INTEGER
+                    tg_message_id INTEGER,
+                    send_attempts INTEGER DEFAULT 0,
+                    media TEXT NULL
                 )
             """)
             await db.execute("""
@@ -104,6 +475,74 @@ class Database:
                     invite_link TEXT
                 )
             """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    from_chat_id INTEGER,
+                    message_id INTEGER,
+                    admin_chat_id INTEGER,
+                    cursor INTEGER DEFAULT 0,
+                    delivered INTEGER DEFAULT 0,
+                    blocked INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    status TEXT DEFAULT 'running',
+                    created_at TEXT
+                )
+            """)
+            await db.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.archive} (
+                    msg_id TEXT PRIMARY KEY,
+                    from_user_id INTEGER,
+                    to_user_id INTEGER,
+                    content_type TEXT,
+                    content_text TEXT,
+                    file_id TEXT,
+                    caption TEXT,
+                    revealed BOOLEAN DEFAULT 0,
+                    sent_at TEXT,
+                    scheduled_time TEXT NULL,
+                    tg_message_id INTEGER,
+                    send_attempts INTEGER DEFAULT 0,
+                    media TEXT NULL
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER DEFAULT 0
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS deliveries (
+                    msg_id TEXT PRIMARY KEY,
+                    recipient_id INTEGER,
+                    sender_chat_id INTEGER,
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at TEXT,
+                    last_error TEXT,
+                    created_at TEXT,
+                    album_message_id INTEGER NULL
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS dead_letters (
+                    msg_id TEXT PRIMARY KEY,
+                    recipient_id INTEGER,
+                    sender_chat_id INTEGER,
+                    attempts INTEGER,
+                    last_error TEXT,
+                    failed_at TEXT,
+                    album_message_id INTEGER NULL
+                )
+            """)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS fsm_states (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT,
+                    updated_at REAL
+                )
+            """)
             await db.commit()
 
             # Добавляем новые колонки, если их нет
@@ -123,10 +562,34 @@ class Database:
             except aiosqlite.OperationalError:
                 pass
 
-            await db.commit()
+            try:
+                await db.execute("ALTER TABLE messages ADD COLUMN send_attempts INTEGER DEFAULT 0")
+            except aiosqlite.OperationalError:
+                pass
+
+            for table in ("messages", self.archive):
+                try:
+                    await db.execute(f"ALTER TABLE {table} ADD COLUMN media TEXT NULL")
+                except aiosqlite.OperationalError:
+                    pass
+
+            for table in ("deliveries", "dead_letters"):
+                try:
+                    await db.execute(f"ALTER TABLE {table} ADD COLUMN album_message_id INTEGER NULL")
+                except aiosqlite.OperationalError:
+                    pass
+
+            # Индексы для горячих запросов (recipients.code уже проиндексирован ограничением UNIQUE)
+            await db.execute("""
+                CREATE INDEX IF NOT EXISTS idx_messages_pending ON messages(scheduled_time)
+                WHERE scheduled_time IS NOT NULL AND tg_message_id = 0
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_messages_to_user ON messages(to_user_id)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_messages_from_user ON messages(from_user_id)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states(updated_at)")
 
     async def add_user(self, user_id, username, full_name):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             now = datetime.now().isoformat()
             current_username = username if username else ""
 
@@ -141,52 +604,77 @@ class Database:
                     username=excluded.username, 
                     full_name=excluded.full_name,
                     is_super_admin = MAX(users.is_super_admin, excluded.is_super_admin), 
-                    is_admin = MAX(users.is_admin, excluded.is_admin)
+                    is_admin = MAX(users.is_admin, excluded.is_admin),
+                    blocked_bot = 0
             """, (user_id, username, full_name, now, is_super, is_admin))
-            await db.commit()
+        self.user_cache.pop(user_id)
 
     async def get_user(self, user_id):
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
+        cached = self.user_cache.get(user_id)
+        if cached is not None:
+            return dict(cached)
+
+        version = self.user_cache.version
+        async with self._read() as db:
             async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
                 row = await cursor.fetchone()
-                return dict(row) if row else None
+        if not row:
+            return None
+        user = dict(row)
+        self.user_cache.set(user_id, user, version)
+        return dict(user)
 
     async def set_special_status(self, user_id, status: bool):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET is_special = ? WHERE user_id = ?", (1 if status else 0, user_id))
-            await db.commit()
+        self.user_cache.pop(user_id)
 
     async def set_boss_subscription(self, user_id, days: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             expiry = (datetime.now() + timedelta(days=days)).isoformat()
             await db.execute("UPDATE users SET sub_expiry = ? WHERE user_id = ?", (expiry, user_id))
-            await db.commit()
-
-    async def increment_message_count(self, user_id):
-        async with aiosqlite.connect(self.db_name) as db:
-            today_date = datetime.now().strftime("%Y-%m-%d")
-
-            user_data = await self.get_user(user_id)
-            last_date = user_data.get('last_message_date')
-
-            if last_date != today_date:
-                new_count = 1
-                await db.execute("UPDATE users SET messages_sent_today = 1, last_message_date = ? WHERE user_id = ?",
-                                 (today_date, user_id))
-            else:
-                new_count = user_data.get('messages_sent_today', 0) + 1
-                await db.execute("UPDATE users SET messages_sent_today = messages_sent_today + 1 WHERE user_id = ?",
-                                 (user_id,))
-
-            await db.commit()
-            return new_count
+        self.user_cache.pop(user_id)
+
+    async def reserve_message_slot(self, user_id, limit: Optional[int] = None) -> Optional[int]:
+        """Атомарно засчитывает сообщение в дневной лимит (со сменой дня) одним UPDATE.
+
+        Возвращает новое значение счётчика или None, если лимит limit на сегодня уже исчерпан.
+        """
+        today_date = datetime.now().strftime("%Y-%m-%d")
+        row = await self._enqueue("""
+            UPDATE users SET
+                messages_sent_today = CASE WHEN last_message_date = :today
+                                           THEN messages_sent_today + 1 ELSE 1 END,
+                last_message_date = :today
+            WHERE user_id = :user_id
+              AND (:limit IS NULL OR last_message_date IS NOT :today OR messages_sent_today < :limit)
+            RETURNING messages_sent_today
+        """, {"today": today_date, "user_id": user_id, "limit": limit}, fetch=True, wait=True)
+        self.user_cache.pop(user_id)
+        return row[0] if row else None
+
+    async def load_recipients(self):
+        """Загружает все коды в RecipientDirectory; дальше get_recipient_by_code и get_user_code работают из памяти."""
+        directory = RecipientDirectory()
+        async with self._read() as db:
+            async with db.execute("SELECT user_id, code FROM recipients") as cursor:
+                while rows := await cursor.fetchmany(10000):
+                    for user_id, code in rows:
+                        directory.add(user_id, code)
+        self.recipients = directory
+        logging.info(f"Loaded {len(directory)} recipient codes")
 
     async def get_recipient_by_code(self, code):
-        async with aiosqlite.connect(self.db_name) as db:
+        if self.recipients is not None:
+            user_id = self.recipients.by_code.get(code)
+            if user_id is not None or self.recipients_complete:
+                return user_id
+        async with self._read() as db:
             async with db.execute("SELECT user_id FROM recipients WHERE code = ?", (code,)) as cursor:
                 row = await cursor.fetchone()
-                return row[0] if row else None
+        if row and self.recipients is not None:
+            self.recipients.add(row[0], code)
+        return row[0] if row else None
 
     async def create_recipient_box(self, user_id):
         existing_code = await self.get_user_code(user_id)
@@ -195,103 +683,729 @@ class Database:
 
         while True:
             code = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(6))
-            async with aiosqlite.connect(self.db_name) as db:
-                try:
+            if self.recipients is not None and code in self.recipients.by_code:
+                continue  # Занят — следующий кандидат без обращения к БД
+            try:
+                async with self._write() as db:
                     await db.execute("INSERT INTO recipients (user_id, code) VALUES (?, ?)", (user_id, code))
-                    await db.commit()
-                    return code
-                except aiosqlite.IntegrityError:
-                    continue
+            except aiosqlite.IntegrityError:
+                # Код заняли в другом процессе или ящик этому пользователю уже создал параллельный /start
+                existing_code = await self._get_user_code_from_db(user_id)
+                if existing_code:
+                    return existing_code
+                continue
+            if self.recipients is not None:
+                self.recipients.add(user_id, code)
+            return code
 
     async def get_user_code(self, user_id):
-        async with aiosqlite.connect(self.db_name) as db:
+        if self.recipients is not None:
+            code = self.recipients.by_user.get(user_id)
+            if code is not None or self.recipients_complete:
+                return code
+        code = await self._get_user_code_from_db(user_id)
+        if code and self.recipients is not None:
+            self.recipients.add(user_id, code)
+        return code
+
+    async def _get_user_code_from_db(self, user_id):
+        async with self._read() as db:
             async with db.execute("SELECT code FROM recipients WHERE user_id = ?", (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 return row[0] if row else None
 
     async def save_message(self, msg_data):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("""
-                INSERT INTO messages (msg_id, from_user_id, to_user_id, content_type, content_text, file_id, caption, sent_at, tg_message_id, scheduled_time)
-                VALUES (:msg_id, :from_user_id, :to_user_id, :content_type, :content_text, :file_id, :caption, :sent_at, :tg_message_id, :scheduled_time)
-            """, msg_data)
-            await db.commit()
-
-    async def get_messages_for_sending(self):
-        """Получает запланированные сообщения, время которых наступило."""
-        now = datetime.now().isoformat()
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute(
-                    "SELECT * FROM messages WHERE scheduled_time NOT NULL AND scheduled_time <= ? AND tg_message_id = 0",
-                    (now,)) as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
-
-    async def update_message_tg_id(self, msg_id, tg_message_id):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("UPDATE messages SET tg_message_id = ? WHERE msg_id = ?", (tg_message_id, msg_id))
-            await db.commit()
+        """Фоновая запись: не ждёт commit (см. _enqueue)."""
+        self._enqueue("""
+            INSERT INTO messages (msg_id, from_user_id, to_user_id, content_type, content_text, file_id, caption, sent_at, tg_message_id, scheduled_time, media)
+            VALUES (:msg_id, :from_user_id, :to_user_id, :content_type, :content_text, :file_id, :caption, :sent_at, :tg_message_id, :scheduled_time, :media)
+        """, msg_data)
+
+    async def get_pending_schedule(self):
+        """Возвращает (msg_id, to_user_id, scheduled_time) всех запланированных сообщений, которые ещё не
+        переданы в очередь доставки (сообщения из deliveries и dead_letters доставляет DeliveryQueue)."""
+        async with self._read() as db:
+            async with db.execute("""
+                SELECT msg_id, to_user_id, scheduled_time FROM messages
+                WHERE scheduled_time NOT NULL AND tg_message_id = 0
+                    AND NOT EXISTS (SELECT 1 FROM deliveries d WHERE d.msg_id = messages.msg_id)
+                    AND NOT EXISTS (SELECT 1 FROM dead_letters dl WHERE dl.msg_id = messages.msg_id)
+            """) as cursor:
+                return [(row[0], row[1], row[2]) for row in await cursor.fetchall()]
+
+    async def flush_writes(self):
+        """Дожидается записи всего, что уже стоит в очереди."""
+        await self._enqueue("SELECT 1", (), wait=True)
 
     async def get_message(self, msg_id):
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
+        """Ищет сообщение в messages, а если его там нет — в архиве."""
+        async with self._read() as db:
             async with db.execute("SELECT * FROM messages WHERE msg_id = ?", (msg_id,)) as cursor:
                 row = await cursor.fetchone()
+            if row is None:
+                async with db.execute(f"SELECT * FROM {self.archive} WHERE msg_id = ?", (msg_id,)) as cursor:
+                    row = await cursor.fetchone()
+            return dict(row) if row else None
+
+    async def get_reveal_info(self, msg_id):
+        """Сообщение (из messages или архива) вместе с username/full_name отправителя — одним запросом.
+        Поле archived показывает, в какой таблице лежит сообщение."""
+        async with self._read() as db:
+            async with db.execute(f"""
+                SELECT m.*, u.username AS sender_username, u.full_name AS sender_full_name
+                FROM (
+                    SELECT {MESSAGE_COLUMNS}, 0 AS archived FROM messages WHERE msg_id = :msg_id
+                    UNION ALL
+                    SELECT {MESSAGE_COLUMNS}, 1 AS archived FROM {self.archive} WHERE msg_id = :msg_id
+                    LIMIT 1
+                ) AS m
+                LEFT JOIN users u ON u.user_id = m.from_user_id
+            """, {"msg_id": msg_id}) as cursor:
+                row = await cursor.fetchone()
                 return dict(row) if row else None
 
-    async def update_message_revealed(self, msg_id):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("UPDATE messages SET revealed = 1 WHERE msg_id = ?", (msg_id,))
-            await db.commit()
+    async def update_message_revealed(self, msg_id, archived: bool = False) -> bool:
+        """Помечает сообщение раскрытым. False — оно уже было раскрыто (или не найдено)."""
+        table = self.archive if archived else "messages"
+        rowcount = await self._enqueue(f"UPDATE {table} SET revealed = 1 WHERE msg_id = ? AND revealed = 0",
+                                       (msg_id,), wait=True)
+        return rowcount > 0
+
+    # Только доставленные сообщения: недоставленные ещё ждут планировщик, очередь доставки или повтор из dead_letters
+    ARCHIVABLE = """sent_at < ? AND tg_message_id > 0
+        AND NOT EXISTS (SELECT 1 FROM deliveries d WHERE d.msg_id = messages.msg_id)
+        AND NOT EXISTS (SELECT 1 FROM dead_letters dl WHERE dl.msg_id = messages.msg_id)"""
+
+    async def archive_messages(self, cutoff: str, limit: int = ARCHIVE_BATCH_SIZE) -> int:
+        """Переносит до limit сообщений, отправленных раньше cutoff, в архив. Возвращает число перенесённых.
+
+        Перенос идемпотентен (INSERT OR REPLACE): если архив в отдельном файле и сбой случился между
+        вставкой и удалением, следующий запуск просто повторит пачку."""
+        async with self._write() as db:
+            # Строки обходятся по rowid — порядку вставки, без отдельного индекса по sent_at
+            async with db.execute(f"SELECT rowid FROM messages WHERE {self.ARCHIVABLE} ORDER BY rowid LIMIT ?",
+                                  (cutoff, limit)) as cursor:
+                rowids = [row[0] for row in await cursor.fetchall()]
+            if not rowids:
+                return 0
+            placeholders = ",".join("?" * len(rowids))
+            await db.execute(f"INSERT OR REPLACE INTO {self.archive} ({MESSAGE_COLUMNS}) "
+                             f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE rowid IN ({placeholders})", rowids)
+            await db.execute(f"DELETE FROM messages WHERE rowid IN ({placeholders})", rowids)
+            await db.execute("""
+                INSERT INTO counters (name, value) VALUES ('archived_messages', ?)
+                ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+            """, (len(rowids),))
+        return len(rowids)
+
+    async def _pragma(self, db, name: str) -> int:
+        async with db.execute(f"PRAGMA {name}") as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def maintenance_report(self, cutoff: str) -> dict:
+        """Что сделает обслуживание: сколько сообщений уйдёт в архив и сколько места можно освободить."""
+        async with self._read() as db:
+            async with db.execute(f"""
+                SELECT COUNT(*), COALESCE(SUM(LENGTH(msg_id) + IFNULL(LENGTH(content_text), 0)
+                       + IFNULL(LENGTH(caption), 0) + IFNULL(LENGTH(file_id), 0) + IFNULL(LENGTH(sent_at), 0)), 0)
+                FROM messages WHERE {self.ARCHIVABLE}
+            """, (cutoff,)) as cursor:
+                rows, payload = await cursor.fetchone()
+            page_size = await self._pragma(db, "page_size")
+            return {
+                "cutoff": cutoff,
+                "archivable_messages": rows,
+                "archivable_bytes": payload,
+                "free_bytes": await self._pragma(db, "freelist_count") * page_size,
+                "db_bytes": await self._pragma(db, "page_count") * page_size,
+                "incremental_vacuum": await self._pragma(db, "auto_vacuum") == 2,
+            }
+
+    async def compact(self, step_pages: int = VACUUM_STEP_PAGES) -> int:
+        """Отдаёт ОС свободные страницы и возвращает число освобождённых байт.
+
+        Работает шагами по step_pages, отпуская блокировку записи между шагами. Новые БД создаются с
+        auto_vacuum=INCREMENTAL (см. _open); для старых один раз выполняется полный VACUUM, чтобы включить его."""
+        async with self._write() as db:
+            page_size = await self._pragma(db, "page_size")
+            before = await self._pragma(db, "page_count")
+            if await self._pragma(db, "auto_vacuum") != 2:
+                logging.info("Switching database to auto_vacuum=INCREMENTAL (full VACUUM)...")
+                await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                await db.execute("VACUUM")
 
-    async def get_all_users(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM users") as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+        while True:
+            async with self._write() as db:
+                if not await self._pragma(db, "freelist_count"):
+                    after = await self._pragma(db, "page_count")
+                    await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                    return max(before - after, 0) * page_size  # Запись в WAL может дорастить файл на страницу
+                async with db.execute(f"PRAGMA incremental_vacuum({step_pages})") as cursor:
+                    await cursor.fetchall()  # Прагма выполняется по мере чтения результата
+
+    async def optimize(self):
+        """Обновляет статистику планировщика запросов (ANALYZE только там, где она устарела)."""
+        async with self._write() as db:
+            await db.execute("PRAGMA analysis_limit=1000")
+            await db.execute("PRAGMA optimize")
+
+    async def iter_users(self, columns=("user_id",), batch_size: int = 1000, after_user_id: int = 0,
+                         exclude_banned: bool = False, exclude_blocked: bool = False):
+        """Асинхронно отдаёт пользователей пачками (keyset-пагинация по user_id), не загружая таблицу целиком."""
+        unknown = set(columns) - USER_COLUMNS
+        if unknown:
+            raise ValueError(f"Unknown users columns: {', '.join(sorted(unknown))}")
+
+        select = ", ".join(dict.fromkeys(("user_id", *columns)))
+        where = "user_id > ?"
+        if exclude_banned:
+            where += " AND banned = 0"
+        if exclude_blocked:
+            where += " AND blocked_bot = 0"
+        sql = f"SELECT {select} FROM users WHERE {where} ORDER BY user_id LIMIT ?"
+
+        while True:
+            async with self._read() as db:
+                async with db.execute(sql, (after_user_id, batch_size)) as cursor:
+                    rows = await cursor.fetchall()
+            if not rows:
+                return
+            after_user_id = rows[-1]['user_id']
+            yield [dict(row) for row in rows]
 
     async def get_stats(self):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._read() as db:
             async with db.execute("SELECT COUNT(*) FROM users") as c1:
                 uc = (await c1.fetchone())[0]
             async with db.execute("SELECT COUNT(*) FROM messages") as c2:
                 mc = (await c2.fetchone())[0]
-            return uc, mc
+            async with db.execute("SELECT value FROM counters WHERE name = 'archived_messages'") as c3:
+                archived = await c3.fetchone()
+            return uc, mc + (archived[0] if archived else 0)
 
     async def add_channel(self, channel_id, title, invite_link):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             await db.execute("INSERT OR REPLACE INTO channels (channel_id, title, invite_link) VALUES (?, ?, ?)",
                              (channel_id, title, invite_link))
-            await db.commit()
+        self._channels = None
 
     async def get_channels(self):
-        async with aiosqlite.connect(self.db_name) as db:
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM channels") as cursor:
-                rows = await cursor.fetchall()
-                return [dict(row) for row in rows]
+        """Список обязательных каналов; хранится в памяти до add_channel/delete_channel (или channels_ttl)."""
+        expired = self.channels_ttl is not None and time.monotonic() - self._channels_loaded_at > self.channels_ttl
+        if self._channels is None or expired:
+            async with self._read() as db:
+                async with db.execute("SELECT * FROM channels") as cursor:
+                    self._channels = [dict(row) for row in await cursor.fetchall()]
+            self._channels_loaded_at = time.monotonic()
+        return [dict(ch) for ch in self._channels]
 
     async def delete_channel(self, channel_id):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             await db.execute("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
-            await db.commit()
+        self._channels = None
 
     async def set_ban_status(self, user_id, status: bool):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET banned = ? WHERE user_id = ?", (1 if status else 0, user_id))
-            await db.commit()
+        self.user_cache.pop(user_id)
 
     async def set_admin_status(self, user_id, status: bool):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET is_admin = ? WHERE user_id = ?", (1 if status else 0, user_id))
-            await db.commit()
+        self.user_cache.pop(user_id)
+
+    async def set_blocked_bot(self, user_id, status: bool):
+        async with self._write() as db:
+            await db.execute("UPDATE users SET blocked_bot = ? WHERE user_id = ?", (1 if status else 0, user_id))
+        self.user_cache.pop(user_id)
+
+    # --- Рассылки ---
+    async def create_broadcast(self, from_chat_id, message_id, admin_chat_id) -> dict:
+        async with self._write() as db:
+            cursor = await db.execute("""
+                INSERT INTO broadcasts (from_chat_id, message_id, admin_chat_id, created_at) VALUES (?, ?, ?, ?)
+            """, (from_chat_id, message_id, admin_chat_id, datetime.now().isoformat()))
+            job_id = cursor.lastrowid
+        return await self.get_broadcast(job_id)
+
+    async def get_broadcast(self, job_id):
+        async with self._read() as db:
+            async with db.execute("SELECT * FROM broadcasts WHERE job_id = ?", (job_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def get_unfinished_broadcasts(self):
+        async with self._read() as db:
+            async with db.execute("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY job_id") as cursor:
+                return [dict(row) for row in await cursor.fetchall()]
+
+    async def update_broadcast(self, job_id, cursor_id, delivered, blocked, failed):
+        async with self._write() as db:
+            await db.execute("""
+                UPDATE broadcasts SET cursor = ?, delivered = ?, blocked = ?, failed = ? WHERE job_id = ?
+            """, (cursor_id, delivered, blocked, failed, job_id))
+
+    async def finish_broadcast(self, job_id):
+        async with self._write() as db:
+            await db.execute("UPDATE broadcasts SET status = 'done' WHERE job_id = ?", (job_id,))
+
+    async def count_broadcast_audience(self, after_user_id=0):
+        async with self._read() as db:
+            async with db.execute("SELECT COUNT(*) FROM users WHERE user_id > ? AND blocked_bot = 0",
+                                  (after_user_id,)) as cursor:
+                return (await cursor.fetchone())[0]
+
+    # --- Очередь доставки ---
+    async def add_delivery(self, msg_id, recipient_id, sender_chat_id):
+        """Ставит сообщение в очередь доставки. Ждёт commit: после ответа «принято» задание не потеряется."""
+        now = datetime.now().isoformat()
+        await self._enqueue("""
+            INSERT OR IGNORE INTO deliveries (msg_id, recipient_id, sender_chat_id, next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (msg_id, recipient_id, sender_chat_id, now, now), wait=True)
+
+    async def get_delivery(self, msg_id):
+        async with self._read() as db:
+            async with db.execute("SELECT * FROM deliveries WHERE msg_id = ?", (msg_id,)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def get_pending_deliveries(self):
+        """Возвращает (msg_id, recipient_id, next_attempt_at) всех недоставленных сообщений."""
+        async with self._read() as db:
+            async with db.execute("SELECT msg_id, recipient_id, next_attempt_at FROM deliveries") as cursor:
+                return [(row[0], row[1], row[2]) for row in await cursor.fetchall()]
+
+    async def finish_delivery(self, msg_id, tg_message_id):
+        """Фоновая запись: не ждёт commit (см. _enqueue)."""
+        self._enqueue("UPDATE messages SET tg_message_id = ? WHERE msg_id = ?", (tg_message_id, msg_id))
+        self._enqueue("DELETE FROM deliveries WHERE msg_id = ?", (msg_id,))
+
+    async def set_delivery_album(self, msg_id, album_message_id):
+        """Запоминает отправленный альбом: повтор доставки отправит только сообщение с кнопками.
+        Ждёт commit — иначе после перезапуска альбом ушёл бы получателю второй раз."""
+        await self._enqueue("UPDATE deliveries SET album_message_id = ? WHERE msg_id = ?",
+                            (album_message_id, msg_id), wait=True)
+
+    async def record_delivery_failure(self, msg_id, error: str, next_attempt_at: datetime):
+        await self._enqueue("""
+            UPDATE deliveries SET attempts = attempts + 1, last_error = ?, next_attempt_at = ? WHERE msg_id = ?
+        """, (error, next_attempt_at.isoformat(), msg_id), wait=True)
+
+    async def move_to_dead_letters(self, msg_id, error: str):
+        async with self._write() as db:
+            await db.execute("""
+                INSERT OR REPLACE INTO dead_letters
+                    (msg_id, recipient_id, sender_chat_id, attempts, last_error, failed_at, album_message_id)
+                SELECT msg_id, recipient_id, sender_chat_id, attempts + 1, ?, ?, album_message_id
+                FROM deliveries WHERE msg_id = ?
+            """, (error, datetime.now().isoformat(), msg_id))
+            await db.execute("DELETE FROM deliveries WHERE msg_id = ?", (msg_id,))
+
+    async def get_dead_letters(self, limit: int = 10):
+        """Возвращает (общее число, последние limit записей) из dead_letters."""
+        async with self._read() as db:
+            async with db.execute("SELECT COUNT(*) FROM dead_letters") as cursor:
+                total = (await cursor.fetchone())[0]
+            async with db.execute("SELECT * FROM dead_letters ORDER BY failed_at DESC LIMIT ?", (limit,)) as cursor:
+                return total, [dict(row) for row in await cursor.fetchall()]
+
+    async def replay_dead_letters(self):
+        """Возвращает все записи dead_letters в очередь доставки с обнулённым счётчиком попыток.
+        Возвращает список (msg_id, recipient_id) для передачи воркерам."""
+        now = datetime.now().isoformat()
+        async with self._write() as db:
+            async with db.execute("SELECT msg_id, recipient_id FROM dead_letters") as cursor:
+                jobs = [(row[0], row[1]) for row in await cursor.fetchall()]
+            await db.execute("""
+                INSERT OR REPLACE INTO deliveries
+                    (msg_id, recipient_id, sender_chat_id, next_attempt_at, created_at, album_message_id)
+                SELECT msg_id, recipient_id, sender_chat_id, ?, ?, album_message_id FROM dead_letters
+            """, (now, now))
+            await db.execute("DELETE FROM dead_letters")
+        return jobs
 
 
 db = Database(DB_NAME)
 
 
+# === ХРАНИЛИЩЕ FSM ===
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_states общей базы бота.
+
+    Изменения копятся в памяти и пишутся одной транзакцией раз в FSM_FLUSH_INTERVAL секунд
+    (или сразу при FSM_FLUSH_BATCH изменениях); состояния, не менявшиеся дольше FSM_STATE_TTL, удаляются.
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+        self._pending: dict = {}  # key -> {"state": ..., "data": ...} (только изменённые поля)
+        self._flushing: dict = {}  # Пачка, которая сейчас записывается в БД
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _load(self, key: str, column: str):
+        async with self.db._read() as conn:
+            async with conn.execute(f"SELECT {column} FROM fsm_states WHERE key = ?", (key,)) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else None
+
+    def _put(self, key: str, field: str, value):
+        self._pending.setdefault(key, {})[field] = value
+        if len(self._pending) >= FSM_FLUSH_BATCH:
+            self._wakeup.set()
+
+    def _unflushed(self, key: str, field: str):
+        """Значение поля из ещё не записанных изменений: (True, value) или (False, None)."""
+        for changes in (self._pending.get(key), self._flushing.get(key)):
+            if changes and field in changes:
+                return True, changes[field]
+        return False, None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._put(self._key(key), "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        k = self._key(key)
+        found, state = self._unflushed(k, "state")
+        if found:
+            return state
+        return await self._load(k, "state")
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        self._put(self._key(key), "data", dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        k = self._key(key)
+        found, data = self._unflushed(k, "data")
+        if found:
+            return dict(data)
+        raw = await self._load(k, "data")
+        return json.loads(raw) if raw else {}
+
+    async def flush(self):
+        """Записывает накопленные изменения одной транзакцией."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch = self._flushing = self._pending
+            self._pending = {}
+            try:
+                await self._write_batch(batch)
+            except BaseException:
+                # Возвращаем несохранённое в очередь (в том числе при отмене), не затирая более свежие изменения
+                for k, changes in batch.items():
+                    self._pending[k] = {**changes, **self._pending.get(k, {})}
+                raise
+            finally:
+                self._flushing = {}
+
+    async def _write_batch(self, batch: dict):
+        now = time.time()
+        states = [(k, v["state"], now) for k, v in batch.items() if "state" in v]
+        datas = [(k, json.dumps(v["data"], ensure_ascii=False), now) for k, v in batch.items() if "data" in v]
+        async with self.db._write() as conn:
+            if states:
+                await conn.executemany("""
+                    INSERT INTO fsm_states (key, state, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+                """, states)
+            if datas:
+                await conn.executemany("""
+                    INSERT INTO fsm_states (key, data, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+                """, datas)
+            # Пустые записи (после state.clear()) не храним
+            await conn.executemany("""
+                DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND (data IS NULL OR data = '{}')
+            """, [(k,) for k in batch])
+
+    async def delete_expired(self) -> int:
+        """Удаляет брошенные состояния, не менявшиеся дольше FSM_STATE_TTL."""
+        async with self.db._write() as conn:
+            cursor = await conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (time.time() - FSM_STATE_TTL,))
+            return cursor.rowcount
+
+    async def _flush_loop(self):
+        last_cleanup = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=FSM_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if time.monotonic() - last_cleanup >= FSM_CLEANUP_INTERVAL:
+                    last_cleanup = time.monotonic()
+                    removed = await self.delete_expired()
+                    if removed:
+                        logging.info(f"Removed {removed} expired FSM states")
+            except Exception as e:
+                logging.error(f"FSM storage flush error: {e}")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            # Дожидаемся отмены: прерванная пачка вернётся в _pending и запишется ниже
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+
+def create_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage  # Нужен пакет redis
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(db)
+
+
+storage = create_fsm_storage()
+dp = Dispatcher(storage=storage)
+dp.include_router(router)
+
+
+# === МЕТРИКИ И ПРОФИЛИРОВАНИЕ ===
+class Metrics:
+    """Счётчики и гистограммы с метками; отдаются в текстовом формате Prometheus."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._counters: Dict[str, dict] = {}  # имя -> {метки: значение}
+        self._histograms: Dict[str, dict] = {}  # имя -> {метки: [по корзинам..., сумма, количество]}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        series = self._histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        values = series.get(key)
+        if values is None:
+            values = series[key] = [0] * (len(self.BUCKETS) + 2)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                values[i] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+    @staticmethod
+    def _labels(key: tuple, le: Optional[str] = None) -> str:
+        pairs = list(key) + ([("le", le)] if le is not None else [])
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for kind, metrics_of_kind in (("counter", self._counters), ("histogram", self._histograms)):
+            for name, series in metrics_of_kind.items():
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in series.items():
+                    if kind == "counter":
+                        lines.append(f"{name}{self._labels(key)} {value}")
+                        continue
+                    for bound, count in zip(self.BUCKETS, value):
+                        lines.append(f"{name}_bucket{self._labels(key, str(bound))} {count}")
+                    lines.append(f"{name}_bucket{self._labels(key, '+Inf')} {value[-1]}")
+                    lines.append(f"{name}_sum{self._labels(key)} {value[-2]:.6f}")
+                    lines.append(f"{name}_count{self._labels(key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("anonmsg_update_seconds", "Update handling time by handler and FSM state")
+metrics.describe("anonmsg_update_errors_total", "Exceptions raised by handlers")
+metrics.describe("anonmsg_slow_updates_total", "Updates slower than SLOW_UPDATE_THRESHOLD")
+metrics.describe("anonmsg_db_seconds", "Database method call time")
+metrics.describe("anonmsg_db_errors_total", "Database method exceptions")
+metrics.describe("anonmsg_bot_api_seconds", "Bot API request time by method")
+metrics.describe("anonmsg_bot_api_errors_total", "Bot API request exceptions")
+metrics.describe("anonmsg_deliveries_total", "Delivery queue outcomes: delivered, retried, dead")
+
+
+class SlowUpdateProfiler:
+    """Разбор апдейтов дольше SLOW_UPDATE_THRESHOLD.
+
+    "stack" — пока апдейт не завершился, раз в SLOW_UPDATE_THRESHOLD логируется стек его задачи (где она ждёт).
+    "cprofile" — апдейт профилируется целиком, и если он оказался медленным, статистика сохраняется в PROFILE_DIR.
+    cProfile видит весь поток, включая чужие корутины, поэтому профилируется не больше одного апдейта за раз.
+    """
+
+    def __init__(self, mode: str, threshold: float, directory: str):
+        self.mode = mode if threshold > 0 else ""
+        self.threshold = threshold
+        self.directory = directory
+        self._profiling = False
+
+    def start(self):
+        if self.mode == "cprofile":
+            if self._profiling:
+                return None
+            self._profiling = True
+            profile = cProfile.Profile()
+            profile.enable()
+            return profile
+        if self.mode == "stack":
+            sampling = [None]
+            self._schedule(sampling, asyncio.current_task(), 1)
+            return sampling
+        return None
+
+    def _schedule(self, sampling: list, task: asyncio.Task, n: int):
+        sampling[0] = asyncio.get_running_loop().call_later(self.threshold, self._sample, sampling, task, n)
+
+    def _sample(self, sampling: list, task: asyncio.Task, n: int):
+        if task.done():
+            return
+        # task.get_stack() даёт только верхний кадр, поэтому идём по цепочке await вручную
+        frames, coro = [], task.get_coro()
+        while coro is not None:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is None:
+                break
+            frames.append((frame, frame.f_lineno))
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        stack = "".join(traceback.StackSummary.extract(frames).format())
+        logging.warning(f"Update still running after {n * self.threshold:.2f} sec:\n{stack}")
+        if n < SLOW_UPDATE_MAX_SAMPLES:
+            self._schedule(sampling, task, n + 1)
+
+    def finish(self, token, elapsed: float, handler_name: str):
+        if token is None:
+            return
+        if self.mode == "stack":
+            token[0].cancel()
+            return
+
+        token.disable()
+        self._profiling = False
+        if elapsed < self.threshold:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{datetime.now():%Y%m%d-%H%M%S-%f}-{handler_name}.prof")
+        token.dump_stats(path)
+        logging.warning(f"Slow update ({handler_name}, {elapsed:.2f} sec) profile saved to {path}")
+
+
+slow_update_profiler = SlowUpdateProfiler(SLOW_UPDATE_PROFILE, SLOW_UPDATE_THRESHOLD, PROFILE_DIR)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренний middleware: срабатывает только после фильтров и сообщает внешнему, какой обработчик выбран."""
+
+    async def __call__(self, handler, event, data):
+        info = data.get("metrics_info")
+        if info is not None:
+            info["handler"] = data["handler"].callback.__name__
+        return await handler(event, data)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware роутера: время обработки апдейта по имени обработчика и состоянию FSM."""
+
+    async def __call__(self, handler, event, data):
+        info = data["metrics_info"] = {}
+        state = data.get("raw_state") or "none"
+        token = slow_update_profiler.start()
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("anonmsg_update_errors_total", handler=info.get("handler", "unhandled"),
+                        error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            name = info.get("handler", "unhandled")
+            metrics.observe("anonmsg_update_seconds", elapsed, event=type(event).__name__, handler=name, state=state)
+            if SLOW_UPDATE_THRESHOLD and elapsed >= SLOW_UPDATE_THRESHOLD:
+                metrics.inc("anonmsg_slow_updates_total", handler=name)
+                logging.warning(f"Slow update: {name} in state {state} took {elapsed:.2f} sec")
+            slow_update_profiler.finish(token, elapsed, name)
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого запроса к Bot API по имени метода."""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("anonmsg_bot_api_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("anonmsg_bot_api_seconds", time.perf_counter() - started, method=name)
+
+
+def _timed_db_method(name: str, method):
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except Exception as e:
+            metrics.inc("anonmsg_db_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("anonmsg_db_seconds", time.perf_counter() - started, method=name)
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def setup_metrics():
+    """Подключает сбор метрик: middleware роутера, middleware сессии бота и таймеры методов db."""
+    for observer in (router.message, router.callback_query):
+        observer.outer_middleware(UpdateMetricsMiddleware())
+        observer.middleware(HandlerNameMiddleware())
+    bot.session.middleware(BotApiMetricsMiddleware())
+
+    # Оборачиваются методы экземпляра db, класс Database остаётся без изменений
+    for name, method in inspect.getmembers(db, inspect.iscoroutinefunction):
+        if not name.startswith("_") and name not in ("connect", "close", "create_tables"):
+            setattr(db, name, _timed_db_method(name, method))
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+async def start_metrics_server(port: int = METRICS_PORT) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logging.info(f"Metrics available at http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+
 # === СОСТОЯНИЯ FSM ===
 class SendingFlow(StatesGroup):
     choosing_template = State()
@@ -352,42 +1466,265 @@ def get_user_limit(user_db: dict) -> float:
     return DAILY_MESSAGE_LIMIT  # Базовый лимит
 
 
+def get_sent_today(user_db: dict) -> int:
+    """Сколько сообщений пользователь отправил сегодня (счётчик за прошлые дни не учитывается)."""
+    if user_db.get('last_message_date') != datetime.now().strftime("%Y-%m-%d"):
+        return 0
+    return user_db.get('messages_sent_today') or 0
+
+
+# --- Альбомы ---
+class MediaGroupMiddleware(BaseMiddleware):
+    """Собирает альбом: сообщения с одним media_group_id приходят отдельными апдейтами, поэтому первое
+    ждёт, пока части перестанут приходить (MEDIA_GROUP_WINDOW сек. тишины), и вызывает обработчик один
+    раз с data["album"] — всеми сообщениями альбома по порядку. Остальные части обработчик не вызывают.
+
+    Работает только в состояниях states (ввод анонимного сообщения); в остальных, например в админских
+    сценариях, каждая часть альбома обрабатывается как обычное сообщение."""
+
+    def __init__(self, window: float, states: tuple):
+        self.window = window
+        self.states = {state.state for state in states}
+        self._groups: dict = {}  # (chat_id, media_group_id) -> список сообщений
+
+    async def __call__(self, handler, event: Message, data):
+        if not event.media_group_id or data.get("raw_state") not in self.states:
+            return await handler(event, data)
+
+        key = (event.chat.id, event.media_group_id)
+        group = self._groups.get(key)
+        if group is not None:
+            group.append(event)
+            return None
+        group = self._groups[key] = [event]
+        try:
+            size = 0
+            while size != len(group):
+                size = len(group)
+                await asyncio.sleep(self.window)
+        finally:
+            del self._groups[key]  # В том числе при отмене, иначе следующие части альбома потеряются
+
+        group.sort(key=lambda m: m.message_id)
+        data["album"] = group
+        return await handler(group[0], data)
+
+
+router.message.outer_middleware(
+    MediaGroupMiddleware(MEDIA_GROUP_WINDOW, (SendingFlow.writing_custom, TimeSendingFlow.writing_custom)))
+
+
+# --- Роли ---
+ROLE_USER = "user"
+ROLE_SPECIAL = "special"
+ROLE_BOSS = "boss"
+ROLE_ADMIN = "admin"
+ROLE_SUPER_ADMIN = "super_admin"
+ROLE_RANKS = {ROLE_USER: 0, ROLE_SPECIAL: 1, ROLE_BOSS: 2, ROLE_ADMIN: 3, ROLE_SUPER_ADMIN: 4}
+
+
+class UserRole:
+    """Права пользователя, вычисленные один раз на апдейт (см. RoleMiddleware): строка users, роль,
+    активность подписки Босса и дневной лимит."""
+
+    __slots__ = ("user_id", "row", "role", "is_boss", "limit")
+
+    def __init__(self, user_id: int, row: Optional[dict]):
+        self.user_id = user_id
+        self.row = row
+        self.is_boss = bool(row) and is_boss_active(row.get('sub_expiry'))
+        self.limit = get_user_limit(row) if row else DAILY_MESSAGE_LIMIT
+        if not row:
+            self.role = ROLE_USER
+        elif row.get('is_super_admin'):
+            self.role = ROLE_SUPER_ADMIN
+        elif row.get('is_admin'):
+            self.role = ROLE_ADMIN
+        elif self.is_boss:
+            self.role = ROLE_BOSS
+        elif row.get('is_special'):
+            self.role = ROLE_SPECIAL
+        else:
+            self.role = ROLE_USER
+
+    def at_least(self, role: str) -> bool:
+        return ROLE_RANKS[self.role] >= ROLE_RANKS[role]
+
+    @property
+    def is_admin(self) -> bool:
+        return self.at_least(ROLE_ADMIN)
+
+    @property
+    def is_privileged(self) -> bool:
+        """Босс или админ: безлимит, планировщик и бесплатное раскрытие."""
+        return self.at_least(ROLE_BOSS)
+
+
+class RoleMiddleware(BaseMiddleware):
+    """Внешний middleware роутера: читает пользователя через кэш db.get_user и кладёт UserRole в data["role"].
+    Обработчики и фильтры получают его параметром role и больше не обращаются к БД за правами."""
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            data["role"] = UserRole(user.id, await db.get_user(user.id))
+        return await handler(event, data)
+
+
+class RoleFilter(BaseFilter):
+    """Пропускает апдейт, только если роль пользователя не ниже min_role."""
+
+    def __init__(self, min_role: str):
+        self.min_role = min_role
+
+    async def __call__(self, event, role: Optional[UserRole] = None) -> bool:
+        return role is not None and role.at_least(self.min_role)
+
+
+IsAdmin = RoleFilter(ROLE_ADMIN)
+IsSuperAdmin = RoleFilter(ROLE_SUPER_ADMIN)
+
+router.message.outer_middleware(RoleMiddleware())
+router.callback_query.outer_middleware(RoleMiddleware())
+
+
+class BotIdentity:
+    """Данные бота из getMe: запрашиваются один раз при старте и обновляются через refresh()."""
+
+    def __init__(self):
+        self.me: Optional[User] = None
+
+    @property
+    def username(self) -> str:
+        return self.me.username if self.me else ""
+
+    async def refresh(self) -> User:
+        self.me = await bot.get_me()
+        return self.me
+
+    async def load(self, attempts: int = BOT_INFO_STARTUP_ATTEMPTS) -> User:
+        """refresh() при старте: временные ошибки Telegram повторяются, а не роняют процесс."""
+        delay = 1
+        for attempt in range(1, attempts + 1):
+            try:
+                return await self.refresh()
+            except (TelegramNetworkError, TelegramServerError, TelegramRetryAfter) as e:
+                if attempt == attempts:
+                    raise
+                if isinstance(e, TelegramRetryAfter):
+                    delay = e.retry_after
+                logging.warning(f"getMe failed (attempt {attempt}): {e}; retrying in {delay} sec.")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    def link(self, code: str) -> str:
+        """Личная deep-link ссылка на ящик с кодом code."""
+        return f"https://t.me/{self.username}?start={code}"
+
+
+bot_identity = BotIdentity()
+
+
+# --- Готовые клавиатуры и тексты ---
+# Модели aiogram неизменяемые (frozen), поэтому один экземпляр можно отдавать во все ответы.
+# Собираются один раз при импорте, а не в каждом обработчике.
+TEMPLATE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💌 Признание", callback_data="tpl_confession")],
+    [InlineKeyboardButton(text="✨ Комплимент", callback_data="tpl_compliment")],
+    [InlineKeyboardButton(text="🤔 Вопрос", callback_data="tpl_question")],
+    [InlineKeyboardButton(text="🤬 Хейт", callback_data="tpl_hate")],
+    [InlineKeyboardButton(text="✏️ Свое сообщение", callback_data="tpl_custom")],
+    [InlineKeyboardButton(text="🔙 Отмена", callback_data="cancel")]
+])
+
+PROFILE_BUTTON = InlineKeyboardButton(text="👤 Мой профиль", callback_data="my_profile")
+HELP_BUTTON = InlineKeyboardButton(text="❓ Помощь / FAQ", callback_data="my_help")
+SHARE_URL = "https://t.me/share/url?url={link}"
+
+_ADMIN_KB_ROWS = [
+    [InlineKeyboardButton(text="📢 Рассылка", callback_data="adm_broadcast")],
+    [InlineKeyboardButton(text="🔨 Бан по ID", callback_data="adm_ban")],
+    [InlineKeyboardButton(text="➕ Канал (по ссылке)", callback_data="adm_add_chan")],
+    [InlineKeyboardButton(text="➖ Канал", callback_data="adm_del_chan")],
+    [InlineKeyboardButton(text="📭 Недоставленные", callback_data="adm_dead")]
+]
+ADMIN_KB = InlineKeyboardMarkup(inline_keyboard=_ADMIN_KB_ROWS)
+SUPER_ADMIN_KB = InlineKeyboardMarkup(inline_keyboard=_ADMIN_KB_ROWS + [
+    [InlineKeyboardButton(text="⭐️ Назначить Админа", callback_data="adm_give_admin")],
+    [InlineKeyboardButton(text="✨ Выдать 'Особый'", callback_data="adm_give_special")],
+    [InlineKeyboardButton(text="😎 Выдать 'Босс' (30 дн)", callback_data="adm_give_boss")]
+])
+
+HELP_TEXT = (
+    "❓ <b>Помощь и Ответы на вопросы</b>\n\n"
+    "1. Как отправить анонимное сообщение?\n"
+    "   — Используйте команду /send или отправьте личную ссылку пользователя, которому хотите написать. Ссылку можно взять в разделе /profile.\n\n"
+    "2. Статусы и Бонусы:\n"
+    f"   — 👤 Пользователь: Лимит {DAILY_MESSAGE_LIMIT} сообщений в день.\n"
+    f"   — ✨ Особый: Лимит {SPECIAL_MESSAGE_LIMIT} сообщений в день.\n"
+    "   — 😎 Босс/⭐️ Админ: Безлимит, доступ к планировщику (`/send_time`) и бесплатному раскрытию отправителей.\n\n"
+    "3. Как раскрыть отправителя?\n"
+    "   — Нажмите кнопку 'Раскрыть' под сообщением. Если у вас статус **Босс/Админ**, раскрытие произойдет немедленно. В противном случае, вам нужно связаться с администрацией.\n"
+    "4. Как запланировать сообщение?\n"
+    "   — Используйте команду /send_time (только для Боссов/Админов).\n\n"
+    "5. Как проверить лимит?\n"
+    "   — Используйте команду /limit."
+)
+
+# Ссылка «Связаться с админом» под сообщением: меняется только msg_id
+REVEAL_CONTACT_URL = (f"https://t.me/{SUPER_ADMIN_ID_FOR_LINK}?start=reveal_{{msg_id}}&text=Здравствуйте, "
+                      f"хочу раскрыть отправителя сообщения с ID {{msg_id}}, как открыть эту функцию?")
+
+
 def get_message_kb(msg_id: str, revealed: bool) -> Optional[InlineKeyboardMarkup]:
     if revealed:
         return None
 
-    ready_text = f"Здравствуйте, хочу раскрыть отправителя сообщения с ID {msg_id}, как открыть эту функцию?"
-    link = f"https://t.me/{SUPER_ADMIN_ID_FOR_LINK}?start=reveal_{msg_id}&text={ready_text}"
-
     buttons = [
         [InlineKeyboardButton(text="🔓 Раскрыть", callback_data=f"reveal_{msg_id}")],
-        [InlineKeyboardButton(text="💬 Связаться с админом", url=link)]
+        [InlineKeyboardButton(text="💬 Связаться с админом", url=REVEAL_CONTACT_URL.format(msg_id=msg_id))]
     ]
 
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
 def get_template_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💌 Признание", callback_data="tpl_confession")],
-        [InlineKeyboardButton(text="✨ Комплимент", callback_data="tpl_compliment")],
-        [InlineKeyboardButton(text="🤔 Вопрос", callback_data="tpl_question")],
-        [InlineKeyboardButton(text="🤬 Хейт", callback_data="tpl_hate")],
-        [InlineKeyboardButton(text="✏️ Свое сообщение", callback_data="tpl_custom")],
-        [InlineKeyboardButton(text="🔙 Отмена", callback_data="cancel")]
-    ])
+    return TEMPLATE_KB
+
+
+@lru_cache(maxsize=USER_CACHE_SIZE)
+def get_start_kb(link: str, with_help: bool = True) -> InlineKeyboardMarkup:
+    """Клавиатура /start с личной ссылкой. Ссылка у пользователя постоянная, поэтому клавиатура кэшируется."""
+    rows = [
+        [InlineKeyboardButton(text="📤 Поделиться ссылкой", url=SHARE_URL.format(link=link))],
+        [PROFILE_BUTTON],
+    ]
+    if with_help:
+        rows.append([HELP_BUTTON])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+subscription_cache = TTLCache(SUBSCRIPTION_CACHE_SIZE, SUBSCRIPTION_CACHE_TTL)  # (user_id, channel_id) -> True
 
 
 async def check_subscription(user_id: int) -> bool:
     channels = await db.get_channels()
     if not channels: return True
-    for ch in channels:
-        try:
-            member = await bot.get_chat_member(ch['channel_id'], user_id)
-            if member.status not in ['member', 'administrator', 'creator']: return False
-        except:
+
+    # Проверяем только каналы без свежей положительной проверки, все запросы — параллельно
+    pending = [ch['channel_id'] for ch in channels if not subscription_cache.get((user_id, ch['channel_id']))]
+    if not pending: return True
+
+    results = await asyncio.gather(*(bot.get_chat_member(cid, user_id) for cid in pending), return_exceptions=True)
+    subscribed = True
+    for channel_id, member in zip(pending, results):
+        if isinstance(member, Exception):
             continue
-    return True
+        if member.status in ['member', 'administrator', 'creator']:
+            subscription_cache.set((user_id, channel_id), True)
+        else:
+            subscribed = False
+    return subscribed
 
 
 async def get_subs_kb():
@@ -399,61 +1736,376 @@ async def get_subs_kb():
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-# === ФУНКЦИЯ ОТПРАВКИ СООБЩЕНИЯ (для Send и Scheduler) ===
-async def send_message_to_recipient(msg_db_data: dict, recipient_id: int, message_to_answer: Message = None):
+class TokenBucket:
+    """Ограничитель скорости «token bucket»: rate токенов в секунду, запас не больше capacity."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, по TelegramRetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TelegramRateLimiter:
+    """Общий лимит бота на отправку + минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, rate: float, per_chat_interval: float):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_interval = per_chat_interval
+        self._chat_slots: dict = {}  # chat_id -> время, раньше которого в чат писать нельзя
+
+    def pause(self, seconds: float):
+        self.bucket.pause(seconds)
+
+    async def acquire(self, chat_id: int):
+        now = time.monotonic()
+        slot = max(now, self._chat_slots.get(chat_id, 0.0))
+        self._chat_slots[chat_id] = slot + self.per_chat_interval
+        if len(self._chat_slots) > RATE_LIMIT_MAX_TRACKED_CHATS:
+            self._chat_slots = {cid: t for cid, t in self._chat_slots.items() if t > now}
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        await self.bucket.acquire()
+
+
+telegram_limiter = TelegramRateLimiter(TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_INTERVAL)
+
+
+# === ФУНКЦИЯ ОТПРАВКИ СООБЩЕНИЯ (для очереди доставки и Scheduler) ===
+NEW_MESSAGE_HEADER = "📨 <b>Вам новое анонимное сообщение!</b>\n\n"
+
+
+async def deliver_message(msg_db_data: dict, recipient_id: int) -> Optional[Message]:
+    """Отправляет анонимное сообщение получателю. Ошибки Telegram пробрасываются вызывающему;
+    None — тип содержимого не поддерживается."""
     content_type = msg_db_data['content_type']
+    header = NEW_MESSAGE_HEADER
+    kb = get_message_kb(msg_db_data['msg_id'], False)
+
+    if content_type == ContentType.TEXT:
+        return await bot.send_message(recipient_id, header + msg_db_data['content_text'], reply_markup=kb)
+
+    if content_type == ContentType.STICKER:
+        await bot.send_message(recipient_id, header)
+        return await bot.send_sticker(recipient_id, msg_db_data['file_id'], reply_markup=kb)
+
+    if content_type == MEDIA_GROUP:
+        album_message_id = await send_album(msg_db_data, recipient_id)
+        return await send_album_keyboard(msg_db_data, recipient_id, album_message_id)
+
+    if msg_db_data['file_id'] and content_type in [ContentType.PHOTO, ContentType.VIDEO, ContentType.AUDIO,
+                                                   ContentType.ANIMATION, ContentType.VOICE]:
+        method = getattr(bot, f"send_{content_type}")
+        final_caption = header + (msg_db_data['caption'] or "")
+        return await method(recipient_id, msg_db_data['file_id'], caption=final_caption, reply_markup=kb)
+    return None
+
+
+async def send_album(msg_db_data: dict, recipient_id: int) -> int:
+    """Отправляет альбом одним sendMediaGroup и возвращает id его первого сообщения."""
+    album = MediaGroupBuilder(caption=NEW_MESSAGE_HEADER + (msg_db_data['caption'] or ""))
+    for item in json.loads(msg_db_data['media']):
+        album.add(type=item['type'], media=item['file_id'])
+    sent = await bot.send_media_group(recipient_id, album.build())
+    return sent[0].message_id
+
+
+async def send_album_keyboard(msg_db_data: dict, recipient_id: int, album_message_id: int) -> Message:
+    """У альбома не может быть кнопок, поэтому они уходят отдельным сообщением — ответом на альбом.
+    Отдельный шаг: при его повторе альбом заново не отправляется."""
+    return await bot.send_message(recipient_id, "⬆️ Анонимный альбом",
+                                  reply_markup=get_message_kb(msg_db_data['msg_id'], False),
+                                  reply_to_message_id=album_message_id, allow_sending_without_reply=True)
+
+
+# === РАССЫЛКА ===
+class Broadcast:
+    """Рассылка копии сообщения пулом воркеров с учётом лимитов Telegram.
+
+    Получатели читаются из users пачками по возрастанию user_id. Счётчики обновляются сразу после каждого
+    получателя (их показывает прогресс у админа), а после каждой пачки курсор и счётчики сохраняются в таблицу
+    broadcasts, поэтому после перезапуска рассылка продолжается с места остановки.
+    """
+
+    def __init__(self, job: dict):
+        self.job_id = job['job_id']
+        self.from_chat_id = job['from_chat_id']
+        self.message_id = job['message_id']
+        self.admin_chat_id = job['admin_chat_id']
+        self.cursor = job['cursor']
+        self.delivered = job['delivered']
+        self.blocked = job['blocked']
+        self.failed = job['failed']
+        self.errors = Counter()  # Текст ошибки -> сколько раз встретилась (не больше BROADCAST_MAX_ERROR_KINDS текстов)
+        self.total = 0
+        self.started = time.monotonic()
+        self._processed_at_start = self.processed
+        self._progress_msg: Optional[Message] = None
+
+    @property
+    def processed(self) -> int:
+        return self.delivered + self.blocked + self.failed
+
+    def report(self, finished: bool = False) -> str:
+        elapsed = time.monotonic() - self.started
+        speed = (self.processed - self._processed_at_start) / elapsed if elapsed > 0 else 0
+        title = "✅ Рассылка завершена." if finished else "📢 Идёт рассылка..."
+        return (
+            f"{title} (#{self.job_id})\n"
+            f"Обработано: {self.processed} из {self.total}\n"
+            f"Доставлено: {self.delivered}\n"
+            f"Заблокировали бота: {self.blocked}\n"
+            f"Ошибки: {self.failed}\n"
+            f"Скорость: {speed:.1f} сообщ./сек, прошло {int(elapsed)} сек."
+        ) + self._errors_summary(finished)
+
+    def _record_error(self, error: Exception):
+        text = getattr(error, "message", None) or str(error) or type(error).__name__
+        if text not in self.errors and len(self.errors) >= BROADCAST_MAX_ERROR_KINDS:
+            text = "другие ошибки"
+        self.errors[text] += 1
+
+    def _errors_summary(self, finished: bool) -> str:
+        if not finished or not self.errors:
+            return ""
+        lines = [f"• {html.quote(text[:200])} — {count}"
+                 for text, count in self.errors.most_common(BROADCAST_ERRORS_IN_REPORT)]
+        return "\n\nЧастые ошибки:\n" + "\n".join(lines)
+
+    async def run(self):
+        self.total = self.processed + await db.count_broadcast_audience(self.cursor)
+        action = "Продолжаю" if self.cursor else "Начинаю"
+        try:
+            self._progress_msg = await bot.send_message(
+                self.admin_chat_id, f"{action} рассылку #{self.job_id} на {self.total} чел...")
+        except Exception as e:
+            # Без сообщения о прогрессе рассылка всё равно идёт; итог придёт отдельным сообщением
+            logging.error(f"Broadcast #{self.job_id} progress message failed: {e}")
+
+        queue = asyncio.Queue()
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(BROADCAST_WORKERS)]
+        progress = asyncio.create_task(self._progress_loop())
+        try:
+            async for batch in db.iter_users(batch_size=BROADCAST_BATCH_SIZE, after_user_id=self.cursor,
+                                             exclude_blocked=True):
+                for user in batch:
+                    queue.put_nowait(user['user_id'])
+                await queue.join()
+                self.cursor = batch[-1]['user_id']
+                await db.update_broadcast(self.job_id, self.cursor, self.delivered, self.blocked, self.failed)
+            await db.finish_broadcast(self.job_id)
+        finally:
+            progress.cancel()
+            for w in workers:
+                w.cancel()
+
+        await self._update_progress(finished=True)
+        logging.info(f"Broadcast #{self.job_id} finished: "
+                     f"{self.delivered} delivered, {self.blocked} blocked, {self.failed} failed")
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            uid = await queue.get()
+            try:
+                try:
+                    status = await self._deliver(uid)
+                except Exception as e:
+                    # Воркер не должен умирать: иначе queue.join() в run() никогда не дождётся пачки
+                    logging.error(f"Broadcast to {uid} failed: {e}")
+                    self._record_error(e)
+                    status = "failed"
+                setattr(self, status, getattr(self, status) + 1)  # delivered / blocked / failed
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, uid: int) -> str:
+        for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+            await telegram_limiter.acquire(uid)
+            try:
+                await bot.copy_message(uid, self.from_chat_id, self.message_id)
+                return "delivered"
+            except TelegramRetryAfter as e:
+                # Flood control касается всего бота — притормаживаем всех воркеров
+                telegram_limiter.pause(e.retry_after)
+                self._record_error(e)
+            except TelegramForbiddenError:
+                await db.set_blocked_bot(uid, True)
+                return "blocked"
+            except TelegramBadRequest as e:
+                self._record_error(e)
+                return "failed"
+            except (TelegramNetworkError, TelegramServerError) as e:
+                self._record_error(e)
+                await asyncio.sleep(attempt)
+            except Exception as e:
+                logging.error(f"Broadcast to {uid} failed: {e}")
+                self._record_error(e)
+                return "failed"
+        return "failed"
+
+    async def _progress_loop(self):
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await self._update_progress()
+
+    async def _update_progress(self, finished: bool = False):
+        try:
+            if self._progress_msg is not None:
+                await self._progress_msg.edit_text(self.report(finished))
+            elif finished:
+                await bot.send_message(self.admin_chat_id, self.report(finished))
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.error(f"Broadcast progress update failed: {e}")
+        except Exception as e:
+            logging.error(f"Broadcast progress update failed: {e}")
+
+
+active_broadcasts = set()  # Ссылки на задачи рассылок, чтобы их не собрал GC
+
+
+def start_broadcast_task(job: dict):
+    task = asyncio.create_task(Broadcast(job).run())
+    active_broadcasts.add(task)
+    task.add_done_callback(active_broadcasts.discard)
+    task.add_done_callback(lambda done: _on_broadcast_done(job, done))
 
+
+def _on_broadcast_done(job: dict, task: asyncio.Task):
+    """Падение рассылки (ошибка БД и т.п.) логируется и сообщается админу, а не теряется в asyncio."""
+    if task.cancelled() or task.exception() is None:
+        return
+    error = task.exception()
+    logging.error(f"Broadcast #{job['job_id']} crashed: {error}", exc_info=error)
+    notice = asyncio.create_task(_notify_broadcast_failure(job, error))
+    active_broadcasts.add(notice)
+    notice.add_done_callback(active_broadcasts.discard)
+
+
+async def _notify_broadcast_failure(job: dict, error: Exception):
+    await telegram_limiter.acquire(job['admin_chat_id'])
     try:
-        sent_msg = None
-        header = "📨 <b>Вам новое анонимное сообщение!</b>\n\n"
+        await bot.send_message(
+            job['admin_chat_id'],
+            f"❌ Рассылка #{job['job_id']} остановлена из-за ошибки: {html.quote(str(error)[:200])}\n"
+            f"Она продолжится с сохранённого места после перезапуска бота.")
+    except Exception as e:
+        logging.error(f"Broadcast #{job['job_id']} failure notice failed: {e}")
 
-        kb = get_message_kb(msg_db_data['msg_id'], False)
 
-        if content_type == ContentType.TEXT:
-            sent_msg = await bot.send_message(recipient_id, header + msg_db_data['content_text'], reply_markup=kb)
+async def resume_broadcasts():
+    """Продолжает рассылки, прерванные перезапуском бота."""
+    for job in await db.get_unfinished_broadcasts():
+        logging.info(f"Resuming broadcast #{job['job_id']} from user_id > {job['cursor']}")
+        start_broadcast_task(job)
 
-        elif content_type == ContentType.STICKER:
-            await bot.send_message(recipient_id, header)
-            sent_msg = await bot.send_sticker(recipient_id, msg_db_data['file_id'], reply_markup=kb)
 
-        elif msg_db_data['file_id']:
-            method = getattr(bot, f"send_{content_type}", None)
-            if method is None:
-                if message_to_answer:
-                    await message_to_answer.answer("⚠️ Неподдерживаемый медиа-тип.")
-                return False
+# === РАСКРЫТИЕ ОТПРАВИТЕЛЯ ===
+class RevealService:
+    """Раскрытие отправителя: сообщение и данные отправителя читаются одним запросом (get_reveal_info),
+    отметка ставится одним условным UPDATE.
 
-            final_caption = header + (msg_db_data['caption'] or "")
+    Одновременные запросы по одному msg_id (двойные клики, много админов на одном сообщении) не
+    дублируют работу: пока чтение или раскрытие выполняется, остальные ждут ту же задачу.
+    """
 
-            if content_type in [ContentType.PHOTO, ContentType.VIDEO, ContentType.AUDIO, ContentType.ANIMATION,
-                                ContentType.VOICE]:
-                sent_msg = await method(recipient_id, msg_db_data['file_id'], caption=final_caption, reply_markup=kb)
-            else:
-                if message_to_answer:
-                    await message_to_answer.answer("⚠️ Неподдерживаемый медиа-тип.")
-                return False
+    def __init__(self):
+        self._lookups: dict = {}  # msg_id -> задача get_reveal_info
+        self._reveals: dict = {}  # msg_id -> задача _reveal
+
+    @staticmethod
+    def _shared(tasks: dict, msg_id: str, factory):
+        task = tasks.get(msg_id)
+        if task is None:
+            task = asyncio.create_task(factory())
+            tasks[msg_id] = task
+            task.add_done_callback(lambda _: tasks.pop(msg_id, None))
+        return asyncio.shield(task)  # Отмена одного ожидающего не отменяет задачу для остальных
+
+    async def lookup(self, msg_id: str) -> Optional[dict]:
+        return await self._shared(self._lookups, msg_id, lambda: db.get_reveal_info(msg_id))
+
+    @staticmethod
+    def sender_display(msg: dict) -> str:
+        return get_sender_display(msg, {
+            "user_id": msg['from_user_id'],
+            "username": msg['sender_username'],
+            "full_name": msg['sender_full_name'],
+        })
+
+    async def reveal(self, chat_id: int, msg: dict, is_command: bool = False) -> Optional[bool]:
+        """Раскрывает сообщение и редактирует его в чате получателя. None — его уже раскрыли."""
+        return await self._shared(self._reveals, msg['msg_id'], lambda: self._reveal(chat_id, msg, is_command))
+
+    async def _reveal(self, chat_id: int, msg: dict, is_command: bool) -> Optional[bool]:
+        if not await db.update_message_revealed(msg['msg_id'], msg['archived']):
+            return None
+        display_text = f"🕵️‍♂️ <b>Отправитель раскрыт:</b> {self.sender_display(msg)}"
+
+        if is_command:
+            return bool(msg['tg_message_id'])
+
+        try:
+            if msg['content_type'] == ContentType.TEXT:
+                new_text = f"{display_text}\n\n{msg['content_text']}"
+                await bot.edit_message_text(new_text, chat_id=chat_id, message_id=msg['tg_message_id'],
+                                            reply_markup=None)
+
+            elif msg['content_type'] == MEDIA_GROUP:
+                await bot.edit_message_text(display_text, chat_id=chat_id, message_id=msg['tg_message_id'],
+                                            reply_markup=None)
+
+            elif msg['content_type'] == ContentType.STICKER:
+                await bot.send_message(chat_id, display_text, reply_to_message_id=msg['tg_message_id'])
+                await bot.edit_message_reply_markup(chat_id=chat_id, message_id=msg['tg_message_id'],
+                                                    reply_markup=None)
+
+            elif msg['file_id']:
+                new_caption = f"{display_text}\n\n{msg['caption'] or ''}"
+                await bot.edit_message_caption(caption=new_caption, chat_id=chat_id,
+                                               message_id=msg['tg_message_id'], reply_markup=None)
 
-        if sent_msg:
-            await db.update_message_tg_id(msg_db_data['msg_id'], sent_msg.message_id)
             return True
-        return False
 
-    except TelegramForbiddenError:
-        if message_to_answer:
-            await message_to_answer.answer("⚠️ Пользователь заблокировал бота.")
-        return False
-    except Exception as e:
-        logging.error(f"Err sending: {e}")
-        if message_to_answer:
-            await message_to_answer.answer("⚠️ Ошибка отправки.")
-        return False
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                logging.error(f"Error during message edit: {e}")
+            return True
+        except Exception as e:
+            logging.error(f"Error during message edit: {e}")
+            return False
+
+
+reveal_service = RevealService()
 
 
 # --- HANDLERS ---
 
 ## 1. Start Command & Subscription Check
 @router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, bot_identity: BotIdentity):
     user = message.from_user
     await db.add_user(user.id, user.username, user.full_name)
     user_db = await db.get_user(user.id)
@@ -468,8 +2120,7 @@ async def cmd_start(message: Message, state: FSMContext):
 
     # Получаем личную ссылку пользователя
     code = await db.get_user_code(user.id) or await db.create_recipient_box(user.id)
-    me = await bot.get_me()
-    my_link = f"https://t.me/{me.username}?start={code}"
+    my_link = bot_identity.link(code)
 
     # Deep Link Logic
     args = message.text.split()
@@ -485,10 +2136,7 @@ async def cmd_start(message: Message, state: FSMContext):
             f"🔗 <b>Твоя личная ссылка для анонимных сообщений:</b>\n"
             f"<code>{my_link}</code>\n\n"
             f"<i>Можешь делиться ею с друзьями!</i>",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="📤 Поделиться ссылкой", url=f"https://t.me/share/url?url={my_link}")],
-                [InlineKeyboardButton(text="👤 Мой профиль", callback_data="my_profile")],
-            ]),
+            reply_markup=get_start_kb(my_link, with_help=False),
             disable_web_page_preview=True
         )
 
@@ -500,10 +2148,9 @@ async def cmd_start(message: Message, state: FSMContext):
         await state.update_data(target_code=start_payload, target_id=recipient_id)
 
         # Проверка лимита перед началом отправки
-        user_db = await db.get_user(user.id)
         current_limit = get_user_limit(user_db)
 
-        if current_limit != float('inf') and user_db.get('messages_sent_today', 0) >= current_limit:
+        if current_limit != float('inf') and get_sent_today(user_db) >= current_limit:
             return await message.answer(
                 f"❌ Вы превысили лимит в {current_limit} анонимных сообщений в день. Попробуйте завтра или получите новый статус.")
 
@@ -515,11 +2162,7 @@ async def cmd_start(message: Message, state: FSMContext):
     # Normal Start Logic
     await message.answer(
         f"👋 Привет, {user.first_name}!\n🔗 <b>Твоя ссылка для анонимных сообщений:</b>\n<code>{my_link}</code>",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📤 Поделиться ссылкой", url=f"https://t.me/share/url?url={my_link}")],
-            [InlineKeyboardButton(text="👤 Мой профиль", callback_data="my_profile")],
-            [InlineKeyboardButton(text="❓ Помощь / FAQ", callback_data="my_help")]
-        ]),
+        reply_markup=get_start_kb(my_link),
         disable_web_page_preview=True
     )
 
@@ -537,21 +2180,7 @@ async def check_subs_btn(callback: CallbackQuery):
 @router.message(Command("help"))
 @router.callback_query(F.data == "my_help")
 async def cmd_help(event: Union[Message, CallbackQuery]):
-    text = (
-        "❓ <b>Помощь и Ответы на вопросы</b>\n\n"
-        "1. Как отправить анонимное сообщение?\n"
-        "   — Используйте команду /send или отправьте личную ссылку пользователя, которому хотите написать. Ссылку можно взять в разделе /profile.\n\n"
-        "2. Статусы и Бонусы:\n"
-        f"   — 👤 Пользователь: Лимит {DAILY_MESSAGE_LIMIT} сообщений в день.\n"
-        f"   — ✨ Особый: Лимит {SPECIAL_MESSAGE_LIMIT} сообщений в день.\n"
-        "   — 😎 Босс/⭐️ Админ: Безлимит, доступ к планировщику (`/send_time`) и бесплатному раскрытию отправителей.\n\n"
-        "3. Как раскрыть отправителя?\n"
-        "   — Нажмите кнопку 'Раскрыть' под сообщением. Если у вас статус **Босс/Админ**, раскрытие произойдет немедленно. В противном случае, вам нужно связаться с администрацией.\n"
-        "4. Как запланировать сообщение?\n"
-        "   — Используйте команду /send_time (только для Боссов/Админов).\n\n"
-        "5. Как проверить лимит?\n"
-        "   — Используйте команду /limit."
-    )
+    text = HELP_TEXT
     if isinstance(event, Message):
         await event.answer(text)
     else:
@@ -561,16 +2190,16 @@ async def cmd_help(event: Union[Message, CallbackQuery]):
 
 ## 3. Limit Check
 @router.message(Command("limit"))
-async def cmd_limit(message: Message):
-    user_db = await db.get_user(message.from_user.id)
+async def cmd_limit(message: Message, role: UserRole):
+    user_db = role.row
 
     if user_db:
-        current_limit = get_user_limit(user_db)
+        current_limit = role.limit
 
         if current_limit == float('inf'):
             status_text = "✅ У вас нет ограничений на отправку сообщений! (Статус: Босс/Админ)"
         else:
-            sent = user_db.get('messages_sent_today', 0)
+            sent = get_sent_today(user_db)
             remaining = int(current_limit) - sent
 
             if remaining > 0:
@@ -587,14 +2216,13 @@ async def cmd_limit(message: Message):
 
 ## 4. Sending Flow (Immediate)
 @router.message(Command("send"))
-async def cmd_send(message: Message, state: FSMContext):
+async def cmd_send(message: Message, state: FSMContext, role: UserRole):
     if not await check_subscription(message.from_user.id):
         return await message.answer("⚠️ Подпишитесь на каналы!", reply_markup=await get_subs_kb())
 
-    user_db = await db.get_user(message.from_user.id)
-    current_limit = get_user_limit(user_db)
+    current_limit = role.limit
 
-    if current_limit != float('inf') and user_db.get('messages_sent_today', 0) >= current_limit:
+    if current_limit != float('inf') and get_sent_today(role.row or {}) >= current_limit:
         return await message.answer(
             f"❌ Вы превысили лимит в {int(current_limit)} анонимных сообщений в день. Попробуйте завтра или получите новый статус.")
 
@@ -622,16 +2250,31 @@ async def tpl_chosen(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
-@router.message(SendingFlow.writing_custom)
-async def receive_content(message: Message, state: FSMContext):
-    if message.content_type not in SUPPORTED_CONTENT_TYPES:
-        return await message.answer("❌ Этот тип файлов не поддерживается.")
+def get_file_id(message: Message) -> Optional[str]:
+    if message.photo:
+        return message.photo[-1].file_id
+    media = message.video or message.voice or message.audio or message.animation or message.sticker
+    return media.file_id if media else None
+
+
+def extract_content(message: Message, prefix: str, album: Optional[list] = None) -> Optional[dict]:
+    """Содержимое анонимного сообщения для FSM: одно сообщение или альбом. None — тип не поддерживается."""
+    if album:
+        if any(m.content_type not in ALBUM_CONTENT_TYPES for m in album):
+            return None
+        caption = next((m.caption for m in album if m.caption), "")
+        return {
+            "content_type": MEDIA_GROUP,
+            "content_text": "",
+            "file_id": None,
+            "caption": prefix + caption,
+            "media": [{"type": m.content_type, "file_id": get_file_id(m)} for m in album],
+        }
 
-    data = await state.get_data()
-    prefix = data.get("prefix", "")
+    if message.content_type not in SUPPORTED_CONTENT_TYPES:
+        return None
 
     content_text = ""
-    file_id = None
     caption = ""
 
     if message.text: content_text = prefix + message.text
@@ -640,35 +2283,33 @@ async def receive_content(message: Message, state: FSMContext):
     elif prefix and not message.text:
         caption = prefix
 
-    if message.photo:
-        file_id = message.photo[-1].file_id
-    elif message.video:
-        file_id = message.video.file_id
-    elif message.voice:
-        file_id = message.voice.file_id
-    elif message.audio:
-        file_id = message.audio.file_id
-    elif message.animation:
-        file_id = message.animation.file_id
-    elif message.sticker:
-        file_id = message.sticker.file_id
-
-    await state.update_data(
-        content_type=message.content_type,
-        content_text=content_text,
-        file_id=file_id,
-        caption=caption,
-    )
+    return {
+        "content_type": message.content_type,
+        "content_text": content_text,
+        "file_id": get_file_id(message),
+        "caption": caption,
+        "media": None,
+    }
+
+
+@router.message(SendingFlow.writing_custom)
+async def receive_content(message: Message, state: FSMContext, role: UserRole, album: Optional[list] = None):
+    data = await state.get_data()
+    content = extract_content(message, data.get("prefix", ""), album)
+    if content is None:
+        return await message.answer("❌ Этот тип файлов не поддерживается.")
+
+    await state.update_data(**content)
 
     if data.get("target_id"):
-        await finalize_sending_immediate(message, state)
+        await finalize_sending_immediate(message, state, role)
     else:
         await message.answer("📬 Введите <b>код получателя</b> (или ссылку):")
         await state.set_state(SendingFlow.sending_to)
 
 
 @router.message(SendingFlow.sending_to)
-async def process_code(message: Message, state: FSMContext):
+async def process_code(message: Message, state: FSMContext, role: UserRole):
     text = message.text.strip()
     code = text.split("start=")[-1] if "start=" in text else text
 
@@ -681,12 +2322,21 @@ async def process_code(message: Message, state: FSMContext):
         return await message.answer("❌ Нельзя отправлять себе.")
 
     await state.update_data(target_id=recipient_id)
-    await finalize_sending_immediate(message, state)
+    await finalize_sending_immediate(message, state, role)
 
 
-async def finalize_sending_immediate(message: Message, state: FSMContext):
+async def finalize_sending_immediate(message: Message, state: FSMContext, role: UserRole):
     data = await state.get_data()
     recipient_id = data['target_id']
+
+    # Проверка и учёт лимита — одна атомарная операция
+    current_limit = role.limit
+    slot_limit = None if current_limit == float('inf') else int(current_limit)
+    if await db.reserve_message_slot(message.from_user.id, slot_limit) is None:
+        await state.clear()
+        return await message.answer(
+            f"❌ Вы превысили лимит в {slot_limit} анонимных сообщений в день. Попробуйте завтра или получите новый статус.")
+
     msg_id = secrets.token_hex(8)
     now = datetime.now().isoformat()
 
@@ -698,30 +2348,25 @@ async def finalize_sending_immediate(message: Message, state: FSMContext):
         "content_text": data.get("content_text"),
         "file_id": data.get("file_id"),
         "caption": data.get("caption"),
+        "media": json.dumps(data["media"]) if data.get("media") else None,
         "sent_at": now,
         "scheduled_time": None,
         "tg_message_id": 0
     }
 
     await db.save_message(msg_db_data)
+    await db.add_delivery(msg_id, recipient_id, message.chat.id)
+    submit_delivery(msg_id, recipient_id)
 
-    await db.increment_message_count(message.from_user.id)
-
-    success = await send_message_to_recipient(msg_db_data, recipient_id, message)
-    if success:
-        await message.answer("✅ Сообщение успешно отправлено!")
-
+    await message.answer("📨 Сообщение принято! Сообщу, когда оно будет доставлено.")
     await state.clear()
 
 
 ## 5. Scheduled Sending Flow
 @router.message(Command("send_time"))
-async def cmd_send_time(message: Message, state: FSMContext):
-    user_db = await db.get_user(message.from_user.id)
+async def cmd_send_time(message: Message, state: FSMContext, role: UserRole):
     # Только Админ и Босс имеют доступ к планировщику
-    is_admin_or_boss = user_db.get('is_admin', False) or is_boss_active(user_db.get('sub_expiry'))
-
-    if not user_db or not is_admin_or_boss:
+    if not role.is_privileged:
         return await message.answer("❌ Для запланированной отправки требуется статус <b>😎 Босс</b> или ⭐️ Админ.")
 
     await state.clear()
@@ -736,41 +2381,13 @@ async def tpl_chosen_time(callback: CallbackQuery, state: FSMContext):
 
 
 @router.message(TimeSendingFlow.writing_custom)
-async def receive_content_time(message: Message, state: FSMContext):
-    if message.content_type not in SUPPORTED_CONTENT_TYPES:
-        return await message.answer("❌ Этот тип файлов не поддерживается.")
-
+async def receive_content_time(message: Message, state: FSMContext, album: Optional[list] = None):
     data = await state.get_data()
-    prefix = data.get("prefix", "")
-    content_text = ""
-    file_id = None
-    caption = ""
-
-    if message.text: content_text = prefix + message.text
-    if message.caption:
-        caption = prefix + message.caption
-    elif prefix and not message.text:
-        caption = prefix
+    content = extract_content(message, data.get("prefix", ""), album)
+    if content is None:
+        return await message.answer("❌ Этот тип файлов не поддерживается.")
 
-    if message.photo:
-        file_id = message.photo[-1].file_id
-    elif message.video:
-        file_id = message.video.file_id
-    elif message.voice:
-        file_id = message.voice.file_id
-    elif message.audio:
-        file_id = message.audio.file_id
-    elif message.animation:
-        file_id = message.animation.file_id
-    elif message.sticker:
-        file_id = message.sticker.file_id
-
-    await state.update_data(
-        content_type=message.content_type,
-        content_text=content_text,
-        file_id=file_id,
-        caption=caption
-    )
+    await state.update_data(**content)
 
     await message.answer("📬 Введите <b>код получателя</b> (или ссылку):")
     await state.set_state(TimeSendingFlow.sending_to)
@@ -817,12 +2434,14 @@ async def process_time_input(message: Message, state: FSMContext):
         "content_text": data.get("content_text"),
         "file_id": data.get("file_id"),
         "caption": data.get("caption"),
+        "media": json.dumps(data["media"]) if data.get("media") else None,
         "sent_at": now,
         "scheduled_time": schedule_iso,
         "tg_message_id": 0
     }
 
     await db.save_message(msg_db_data)
+    await schedule_message(msg_id, data['target_id'], schedule_dt)
 
     await message.answer(f"✅ Сообщение запланировано на <b>{message.text.strip()}</b>.")
     await state.clear()
@@ -830,22 +2449,20 @@ async def process_time_input(message: Message, state: FSMContext):
 
 ## 6. Reveal Handler (Callback Query)
 @router.callback_query(F.data.startswith("reveal_"))
-async def reveal_handler(callback: CallbackQuery):
+async def reveal_handler(callback: CallbackQuery, role: UserRole):
     msg_id = callback.data.split("_")[1]
-    msg = await db.get_message(msg_id)
+    msg = await reveal_service.lookup(msg_id)
     if not msg: return await callback.answer("Ошибка: сообщение не найдено", show_alert=True)
 
-    user_who_clicked = await db.get_user(callback.from_user.id)
     # Админы/Супер-Админы и Боссы могут раскрывать
-    is_privileged = user_who_clicked.get('is_admin', False) or is_boss_active(user_who_clicked.get('sub_expiry'))
+    is_privileged = role.is_privileged
 
     if msg['revealed']:
-        sender = await db.get_user(msg['from_user_id'])
-        return await callback.answer(f"Отправитель: {get_sender_display(msg, sender)}", show_alert=True)
+        return await callback.answer(f"Отправитель: {reveal_service.sender_display(msg)}", show_alert=True)
 
     # Логика: Если пользователь Привилегирован -> Раскрываем
     if is_privileged:
-        await perform_reveal(callback.message.chat.id, msg)
+        await reveal_service.reveal(callback.message.chat.id, msg)
         await callback.answer("Успешно раскрыто!", show_alert=True)
         return
 
@@ -857,25 +2474,23 @@ async def reveal_handler(callback: CallbackQuery):
 
 ## 7. Reveal Handler (Command for Admins)
 @router.message(Command("reveal"))
-async def cmd_reveal_by_id(message: Message, command: CommandObject):
-    user_db = await db.get_user(message.from_user.id)
-    if not user_db or not user_db.get('is_admin'):
+async def cmd_reveal_by_id(message: Message, command: CommandObject, role: UserRole):
+    if not role.is_admin:
         return await message.answer("❌ Команда доступна только Администраторам.")
 
     if not command.args:
         return await message.answer("Введите ID сообщения для раскрытия. Формат: `/reveal [ID_сообщения]`")
 
     msg_id = command.args.strip()
-    msg = await db.get_message(msg_id)
+    msg = await reveal_service.lookup(msg_id)
 
     if not msg:
         return await message.answer(f"❌ Сообщение с ID **{msg_id}** не найдено.")
 
-    if msg['revealed']:
-        return await message.answer(f"⚠️ Сообщение с ID **{msg_id}** уже раскрыто.")
-
-    success = await perform_reveal(message.chat.id, msg, is_command=True)
+    success = None if msg['revealed'] else await reveal_service.reveal(message.chat.id, msg, is_command=True)
 
+    if success is None:
+        return await message.answer(f"⚠️ Сообщение с ID **{msg_id}** уже раскрыто.")
     if success:
         await message.answer(f"✅ Сообщение с ID **{msg_id}** успешно раскрыто.")
     else:
@@ -883,48 +2498,13 @@ async def cmd_reveal_by_id(message: Message, command: CommandObject):
             f"⚠️ Ошибка при раскрытии сообщения с ID **{msg_id}**. Возможно, оригинальное сообщение TG удалено.")
 
 
-async def perform_reveal(chat_id: int, msg: dict, is_command: bool = False):
-    """Обновляет статус раскрытия в БД и редактирует сообщение TG."""
-
-    await db.update_message_revealed(msg['msg_id'])
-    sender = await db.get_user(msg['from_user_id'])
-    display_text = f"🕵️‍♂️ <b>Отправитель раскрыт:</b> {get_sender_display(msg, sender)}"
-
-    if is_command:
-        return bool(msg['tg_message_id'])
-
-    try:
-        if msg['content_type'] == ContentType.TEXT:
-            new_text = f"{display_text}\n\n{msg['content_text']}"
-            await bot.edit_message_text(new_text, chat_id=chat_id, message_id=msg['tg_message_id'], reply_markup=None)
-
-        elif msg['content_type'] == ContentType.STICKER:
-            await bot.send_message(chat_id, display_text, reply_to_message_id=msg['tg_message_id'])
-            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=msg['tg_message_id'], reply_markup=None)
-
-        elif msg['file_id']:
-            new_caption = f"{display_text}\n\n{msg['caption'] or ''}"
-            await bot.edit_message_caption(caption=new_caption, chat_id=chat_id, message_id=msg['tg_message_id'],
-                                           reply_markup=None)
-
-        return True
-
-    except TelegramBadRequest as e:
-        if "message is not modified" not in str(e):
-            logging.error(f"Error during message edit: {e}")
-        return True
-    except Exception as e:
-        logging.error(f"Error during message edit: {e}")
-        return False
-
-
 ## 8. Profile
 @router.callback_query(F.data == "my_profile")
 @router.message(Command("profile"))
-async def my_profile(event: Union[Message, CallbackQuery]):
+async def my_profile(event: Union[Message, CallbackQuery], bot_identity: BotIdentity):
     user = event.from_user
     await db.add_user(user.id, user.username, user.full_name)
-    code = await db.get_user_code(user.id)
+    code = await db.get_user_code(user.id) or await db.create_recipient_box(user.id)
     user_db = await db.get_user(user.id)
 
     if not user_db:
@@ -952,6 +2532,7 @@ async def my_profile(event: Union[Message, CallbackQuery]):
         f"👤 <b>Ваш профиль:</b>\n"
         f"🆔 ID: <code>{user.id}</code>\n"
         f"🔑 Код: <code>{code}</code>\n"
+        f"🔗 Ссылка: <code>{bot_identity.link(code)}</code>\n"
         f"🔰 Статус: {status}\n"
         f"🎁 Бонусы: {bonus_info}"
     )
@@ -963,78 +2544,41 @@ async def my_profile(event: Union[Message, CallbackQuery]):
 
 
 ## 9. Admin Panel & Status Management
-@router.message(Command("admin"))
-async def admin_panel(message: Message):
-    user_db = await db.get_user(message.from_user.id)
-    if not user_db or not user_db.get('is_admin'):
-        return await message.answer("❌ Команда не найдена.")
-
+@router.message(Command("admin"), IsAdmin)
+async def admin_panel(message: Message, role: UserRole):
     stats = await db.get_stats()
 
-    kb_rows = [
-        [InlineKeyboardButton(text="📢 Рассылка", callback_data="adm_broadcast")],
-        [InlineKeyboardButton(text="🔨 Бан по ID", callback_data="adm_ban")],
-        [InlineKeyboardButton(text="➕ Канал (по ссылке)", callback_data="adm_add_chan")],
-        [InlineKeyboardButton(text="➖ Канал", callback_data="adm_del_chan")]
-    ]
-
-    if user_db.get('is_super_admin'):
-        kb_rows.append([InlineKeyboardButton(text="⭐️ Назначить Админа", callback_data="adm_give_admin")])
-        kb_rows.append([InlineKeyboardButton(text="✨ Выдать 'Особый'", callback_data="adm_give_special")])
-        kb_rows.append([InlineKeyboardButton(text="😎 Выдать 'Босс' (30 дн)", callback_data="adm_give_boss")])
-
     await message.answer(
         f"👑 <b>Админ-панель</b>\n\n"
         f"👥 Пользователей: {stats[0]}\n"
         f"✉️ Сообщений: {stats[1]}",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows)
+        reply_markup=SUPER_ADMIN_KB if role.at_least(ROLE_SUPER_ADMIN) else ADMIN_KB
     )
 
 
-@router.callback_query(F.data == "adm_broadcast")
+@router.callback_query(F.data == "adm_broadcast", IsAdmin)
 async def start_broadcast(callback: CallbackQuery, state: FSMContext):
-    user_db = await db.get_user(callback.from_user.id)
-    if not user_db or not user_db.get('is_admin'): return await callback.answer("Нет доступа.")
-
     await callback.message.answer("Введите сообщение для рассылки (или перешлите его):")
     await state.set_state(AdminFlow.waiting_for_broadcast)
     await callback.answer()
 
 
-@router.message(AdminFlow.waiting_for_broadcast)
+@router.message(AdminFlow.waiting_for_broadcast, IsAdmin)
 async def process_broadcast(message: Message, state: FSMContext):
-    user_db = await db.get_user(message.from_user.id)
-    if not user_db or not user_db.get('is_admin'): return await message.answer("Нет доступа.")
-
-    users = await db.get_all_users()
-    count = 0
-    await message.answer(f"Начинаю рассылку на {len(users)} чел...")
-    for u in users:
-        try:
-            await bot.copy_message(u['user_id'], message.chat.id, message.message_id)
-            count += 1
-            await asyncio.sleep(0.05)
-        except:
-            pass
-    await message.answer(f"✅ Рассылка завершена. Доставлено: {count}")
+    job = await db.create_broadcast(message.chat.id, message.message_id, message.chat.id)
+    submit_broadcast(job)
     await state.clear()
 
 
-@router.callback_query(F.data == "adm_ban")
+@router.callback_query(F.data == "adm_ban", IsAdmin)
 async def ban_user_start(callback: CallbackQuery, state: FSMContext):
-    user_db = await db.get_user(callback.from_user.id)
-    if not user_db or not user_db.get('is_admin'): return await callback.answer("Нет доступа.")
-
     await callback.message.answer("Введите ID пользователя для бана:")
     await state.set_state(AdminFlow.waiting_for_ban_id)
     await callback.answer()
 
 
-@router.message(AdminFlow.waiting_for_ban_id)
+@router.message(AdminFlow.waiting_for_ban_id, IsAdmin)
 async def process_ban(message: Message, state: FSMContext):
-    user_db = await db.get_user(message.from_user.id)
-    if not user_db or not user_db.get('is_admin'): return await message.answer("Нет доступа.")
-
     try:
         uid = int(message.text)
         await db.set_ban_status(uid, True)
@@ -1046,21 +2590,15 @@ async def process_ban(message: Message, state: FSMContext):
 
 # --- Status Management Handlers ---
 
-@router.callback_query(F.data == "adm_give_admin")
+@router.callback_query(F.data == "adm_give_admin", IsSuperAdmin)
 async def ask_admin(callback: CallbackQuery, state: FSMContext):
-    user_db = await db.get_user(callback.from_user.id)
-    if not user_db or not user_db.get('is_super_admin'): return await callback.answer("Нет доступа.")
-
     await callback.message.answer("Введите ID и статус (1 - назначить, 0 - снять) через пробел для Админа:")
     await state.set_state(AdminFlow.waiting_for_admin_id)
     await callback.answer()
 
 
-@router.message(AdminFlow.waiting_for_admin_id)
+@router.message(AdminFlow.waiting_for_admin_id, IsSuperAdmin)
 async def process_admin_status(message: Message, state: FSMContext):
-    user_db = await db.get_user(message.from_user.id)
-    if not user_db or not user_db.get('is_super_admin'): return await message.answer("Нет доступа.")
-
     try:
         parts = message.text.split()
         if len(parts) < 2: raise ValueError
@@ -1077,21 +2615,15 @@ async def process_admin_status(message: Message, state: FSMContext):
     await state.clear()
 
 
-@router.callback_query(F.data == "adm_give_special")
+@router.callback_query(F.data == "adm_give_special", IsSuperAdmin)
 async def ask_special(callback: CallbackQuery, state: FSMContext):
-    user_db = await db.get_user(callback.from_user.id)
-    if not user_db or not user_db.get('is_super_admin'): return await callback.answer("Нет доступа.")
-
     await callback.message.answer("Введите ID пользователя для статуса 'Особый':")
     await state.set_state(AdminFlow.waiting_for_special_id)
     await callback.answer()
 
 
-@router.message(AdminFlow.waiting_for_special_id)
+@router.message(AdminFlow.waiting_for_special_id, IsSuperAdmin)
 async def give_special(message: Message, state: FSMContext):
-    user_db = await db.get_user(message.from_user.id)
-    if not user_db or not user_db.get('is_super_admin'): return await message.answer("Нет доступа.")
-
     try:
         uid = int(message.text)
         await db.set_special_status(uid, True)
@@ -1101,21 +2633,15 @@ async def give_special(message: Message, state: FSMContext):
     await state.clear()
 
 
-@router.callback_query(F.data == "adm_give_boss")
+@router.callback_query(F.data == "adm_give_boss", IsSuperAdmin)
 async def ask_boss(callback: CallbackQuery, state: FSMContext):
-    user_db = await db.get_user(callback.from_user.id)
-    if not user_db or not user_db.get('is_super_admin'): return await callback.answer("Нет доступа.")
-
     await callback.message.answer("Введите ID для подписки 'Босс' (выдам на 30 дней):")
     await state.set_state(AdminFlow.waiting_for_boss_id)
     await callback.answer()
 
 
-@router.message(AdminFlow.waiting_for_boss_id)
+@router.message(AdminFlow.waiting_for_boss_id, IsSuperAdmin)
 async def give_boss(message: Message, state: FSMContext):
-    user_db = await db.get_user(message.from_user.id)
-    if not user_db or not user_db.get('is_super_admin'): return await message.answer("Нет доступа.")
-
     try:
         uid = int(message.text)
         await db.set_boss_subscription(uid, 30)
@@ -1126,22 +2652,16 @@ async def give_boss(message: Message, state: FSMContext):
 
 
 # --- Channel Management Handlers ---
-@router.callback_query(F.data == "adm_add_chan")
+@router.callback_query(F.data == "adm_add_chan", IsAdmin)
 async def add_chan_start(callback: CallbackQuery, state: FSMContext):
-    user_db = await db.get_user(callback.from_user.id)
-    if not user_db or not user_db.get('is_admin'): return await callback.answer("Нет доступа.")
-
     await callback.message.answer(
         "🔗 Введите ссылку-приглашение (t.me/+AbCdEf...) или @username канала.\n\n⚠️ Бот должен быть там администратором.")
     await state.set_state(AdminFlow.waiting_for_channel_link)
     await callback.answer()
 
 
-@router.message(AdminFlow.waiting_for_channel_link)
+@router.message(AdminFlow.waiting_for_channel_link, IsAdmin)
 async def process_add_chan(message: Message, state: FSMContext):
-    user_db = await db.get_user(message.from_user.id)
-    if not user_db or not user_db.get('is_admin'): return await message.answer("Нет доступа.")
-
     input_text = message.text.strip()
 
     match = re.search(r'(?:t\.me\/|\/joinchat\/)([\w\-\+]+)', input_text)
@@ -1177,11 +2697,8 @@ async def process_add_chan(message: Message, state: FSMContext):
     await state.clear()
 
 
-@router.callback_query(F.data == "adm_del_chan")
+@router.callback_query(F.data == "adm_del_chan", IsAdmin)
 async def del_chan_list(callback: CallbackQuery):
-    user_db = await db.get_user(callback.from_user.id)
-    if not user_db or not user_db.get('is_admin'): return await callback.answer("Нет доступа.")
-
     chans = await db.get_channels()
     if not chans:
         return await callback.message.answer("Список каналов пуст.")
@@ -1192,43 +2709,614 @@ async def del_chan_list(callback: CallbackQuery):
     await callback.message.answer("Нажмите, чтобы удалить:", reply_markup=kb)
 
 
-@router.callback_query(F.data.startswith("delch_"))
+@router.callback_query(F.data.startswith("delch_"), IsAdmin)
 async def process_del_chan(callback: CallbackQuery):
-    user_db = await db.get_user(callback.from_user.id)
-    if not user_db or not user_db.get('is_admin'): return await callback.answer("Нет доступа.")
-
     cid = int(callback.data.split("_")[1])
     await db.delete_channel(cid)
     await callback.answer("Удалено!")
     await callback.message.delete()
 
 
+# --- Dead Letters ---
+@router.callback_query(F.data == "adm_dead", IsAdmin)
+async def dead_letters_list(callback: CallbackQuery):
+    total, rows = await db.get_dead_letters()
+    if not total:
+        await callback.answer("Недоставленных сообщений нет.", show_alert=True)
+        return
+
+    lines = [f"📭 <b>Недоставленные сообщения: {total}</b>\n"]
+    for row in rows:
+        lines.append(f"<code>{row['msg_id']}</code> → {row['recipient_id']}, попыток: {row['attempts']}\n"
+                     f"{html.quote((row['last_error'] or '')[:200])}")
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔁 Повторить все", callback_data="adm_dead_replay")]
+    ])
+    await callback.message.answer("\n".join(lines), reply_markup=kb)
+    await callback.answer()
+
+
+@router.callback_query(F.data == "adm_dead_replay", IsAdmin)
+async def dead_letters_replay(callback: CallbackQuery):
+    jobs = await db.replay_dead_letters()
+    for msg_id, recipient_id in jobs:
+        submit_delivery(msg_id, recipient_id)
+    await callback.answer(f"Повторная отправка: {len(jobs)}", show_alert=True)
+
+
+@router.message(Command("maintenance"), IsAdmin)
+async def cmd_maintenance(message: Message, command: CommandObject):
+    """/maintenance — отчёт без изменений (dry run), /maintenance run — выполнить обслуживание сейчас."""
+    dry_run = (command.args or "").strip() != "run"
+    if not dry_run:
+        await message.answer("⏳ Обслуживание запущено...")
+    report = await run_maintenance(dry_run=dry_run)
+    await message.answer(format_maintenance_report(report))
+
+
+# Сюда попадают админские кнопки, состояния и команды, не прошедшие фильтры ролей выше
+@router.callback_query(F.data.startswith(("adm_", "delch_")))
+async def admin_callback_denied(callback: CallbackQuery):
+    await callback.answer("Нет доступа.")
+
+
+@router.message(StateFilter(AdminFlow))
+async def admin_state_denied(message: Message):
+    await message.answer("Нет доступа.")
+
+
+@router.message(Command("admin", "maintenance"))
+async def admin_command_denied(message: Message):
+    await message.answer("❌ Команда не найдена.")
+
+
 # --- Background Scheduler ---
-async def scheduler_task(sleep_time=10):
+class MessageScheduler:
+    """Планировщик отложенных сообщений: min-heap по времени отправки, сон ровно до ближайшего сообщения.
+
+    Наступившее сообщение передаётся в очередь доставки (deliveries): повторы, dead_letters и уведомление
+    отправителя — общие с обычными сообщениями. Сообщения одному получателю обрабатываются строго по очереди.
+    """
+
+    def __init__(self, workers: int = SCHEDULER_WORKERS):
+        self._heap = []  # (scheduled_time, msg_id, recipient_id)
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(workers)
+        self._recipients: dict = {}  # recipient_id -> deque(msg_id), пока для получателя идёт отправка
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    async def load(self):
+        """Загружает из БД все ещё не отправленные запланированные сообщения."""
+        for msg_id, recipient_id, scheduled_time in await db.get_pending_schedule():
+            try:
+                self.push(msg_id, recipient_id, datetime.fromisoformat(scheduled_time))
+            except ValueError:
+                logging.warning(f"Bad scheduled_time for message {msg_id}: {scheduled_time}")
+
+    def push(self, msg_id: str, recipient_id: int, when: datetime):
+        """Добавляет сообщение в очередь; будит планировщик, если оно стало ближайшим."""
+        heapq.heappush(self._heap, (when, msg_id, recipient_id))
+        if self._heap[0][1] == msg_id:
+            self._wakeup.set()
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = (self._heap[0][0] - datetime.now()).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, msg_id, recipient_id = heapq.heappop(self._heap)
+            self._dispatch(msg_id, recipient_id)
+
+    async def stop(self):
+        """Отменяет начатые отправки и ждёт их завершения. Вызывается после отмены run() и до закрытия БД:
+        неотправленное останется в БД и уйдёт после перезапуска."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _dispatch(self, msg_id: str, recipient_id: int):
+        queue = self._recipients.get(recipient_id)
+        if queue is not None:
+            queue.append(msg_id)  # Отправится после предыдущих сообщений этому получателю
+            return
+        self._recipients[recipient_id] = deque([msg_id])
+        task = asyncio.create_task(self._recipient_worker(recipient_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _recipient_worker(self, recipient_id: int):
+        queue = self._recipients[recipient_id]
+        try:
+            while queue:
+                msg_id = queue.popleft()
+                async with self._slots:
+                    try:
+                        await self._deliver(msg_id, recipient_id)
+                    except Exception as e:
+                        logging.error(f"Scheduler error: {e}")
+        finally:
+            del self._recipients[recipient_id]
+
+    async def _deliver(self, msg_id: str, recipient_id: int):
+        msg = await db.get_message(msg_id)
+        if not msg or msg['tg_message_id']:
+            return  # Удалено или уже отправлено
+        await db.add_delivery(msg_id, recipient_id, msg['from_user_id'])  # Личный чат отправителя = его user_id
+        submit_delivery(msg_id, recipient_id)
+        logging.info(f"Scheduled message {msg_id} to {recipient_id} handed to the delivery queue.")
+
+
+scheduler = MessageScheduler()
+
+
+async def scheduler_task():
     """Фоновая задача для отправки запланированных сообщений."""
-    while True:
-        await asyncio.sleep(sleep_time)
+    await scheduler.load()
+    await scheduler.run()
+
+
+class DeliveryQueue(MessageScheduler):
+    """Доставка обычных (не отложенных) сообщений из таблицы deliveries.
+
+    Очередь и параллелизм те же, что у планировщика; повтор назначается по retry_after при flood control
+    и с экспоненциальной паузой при остальных временных ошибках. Сообщения, которые не удалось доставить
+    за DELIVERY_MAX_ATTEMPTS попыток (или которые доставить невозможно), переносятся в dead_letters,
+    а отправитель получает итог доставки отдельным сообщением.
+    """
+
+    def __init__(self):
+        super().__init__(DELIVERY_WORKERS)
+
+    async def load(self):
+        for msg_id, recipient_id, next_attempt_at in await db.get_pending_deliveries():
+            try:
+                when = datetime.fromisoformat(next_attempt_at)
+            except (TypeError, ValueError):
+                when = datetime.now()
+            self.push(msg_id, recipient_id, when)
+
+    async def _deliver(self, msg_id: str, recipient_id: int):
+        job = await db.get_delivery(msg_id)
+        if not job:
+            return  # Уже доставлено или перенесено в dead_letters
+        msg = await db.get_message(msg_id)
+        if not msg:
+            return await self._give_up(job, "message not found")
+
+        await telegram_limiter.acquire(recipient_id)
+        try:
+            if msg['content_type'] == MEDIA_GROUP:
+                sent_msg = await self._deliver_album(job, msg)
+            else:
+                sent_msg = await deliver_message(msg, recipient_id)
+        except TelegramRetryAfter as e:
+            # Flood control касается всего бота — притормаживаем все отправки
+            telegram_limiter.pause(e.retry_after)
+            return await self._retry(job, str(e), e.retry_after)
+        except TelegramForbiddenError as e:
+            return await self._give_up(job, str(e), "⚠️ Пользователь заблокировал бота.")
+        except TelegramBadRequest as e:
+            return await self._give_up(job, str(e))  # Повтор не поможет
+        except Exception as e:
+            return await self._retry(job, str(e))
+
+        if not sent_msg:
+            return await self._give_up(job, f"unsupported content type {msg['content_type']}",
+                                       "⚠️ Неподдерживаемый медиа-тип.")
+        await db.finish_delivery(msg_id, sent_msg.message_id)
+        metrics.inc("anonmsg_deliveries_total", status="delivered")
+        await self._notify(job['sender_chat_id'], "✅ Сообщение успешно отправлено!")
+
+    @staticmethod
+    async def _deliver_album(job: dict, msg: dict) -> Message:
+        """Альбом и кнопки к нему — два шага; отправленный альбом запоминается, и повтор шлёт только кнопки."""
+        album_message_id = job['album_message_id']
+        if not album_message_id:
+            album_message_id = await send_album(msg, job['recipient_id'])
+            await db.set_delivery_album(job['msg_id'], album_message_id)
+            await telegram_limiter.acquire(job['recipient_id'])
+        return await send_album_keyboard(msg, job['recipient_id'], album_message_id)
+
+    async def _retry(self, job: dict, error: str, delay: Optional[float] = None):
+        if job['attempts'] + 1 >= DELIVERY_MAX_ATTEMPTS:
+            return await self._give_up(job, error)
+
+        if delay is None:
+            delay = min(DELIVERY_RETRY_DELAY * 2 ** job['attempts'], DELIVERY_MAX_RETRY_DELAY)
+        when = datetime.now() + timedelta(seconds=delay)
+        await db.record_delivery_failure(job['msg_id'], error, when)
+        metrics.inc("anonmsg_deliveries_total", status="retried")
+        logging.warning(f"Delivery of {job['msg_id']} to {job['recipient_id']} failed "
+                        f"(attempt {job['attempts'] + 1}): {error}; retrying in {delay} sec.")
+        self.push(job['msg_id'], job['recipient_id'], when)
+
+    async def _give_up(self, job: dict, error: str, notice: str = "⚠️ Ошибка отправки."):
+        await db.move_to_dead_letters(job['msg_id'], error)
+        metrics.inc("anonmsg_deliveries_total", status="dead")
+        logging.error(f"Delivery of {job['msg_id']} to {job['recipient_id']} moved to dead letters: {error}")
+        await self._notify(job['sender_chat_id'], notice)
+
+    @staticmethod
+    async def _notify(chat_id: int, text: str):
+        """Сообщает отправителю итог доставки; ошибка здесь уже не влияет на само сообщение."""
+        await telegram_limiter.acquire(chat_id)
         try:
-            messages_to_send = await db.get_messages_for_sending()
+            await bot.send_message(chat_id, text)
+        except Exception as e:
+            logging.warning(f"Delivery notice to {chat_id} failed: {e}")
 
-            for msg in messages_to_send:
-                recipient_id = msg['to_user_id']
 
-                success = await send_message_to_recipient(msg, recipient_id)
+delivery_queue = DeliveryQueue()
+
+
+async def delivery_task():
+    """Фоновая задача доставки: догружает недоставленное после перезапуска и отправляет новое."""
+    await delivery_queue.load()
+    await delivery_queue.run()
 
-                if success:
-                    logging.info(f"Scheduled message {msg['msg_id']} sent to {recipient_id}.")
-                else:
-                    logging.warning(f"Failed to send scheduled message {msg['msg_id']} to {recipient_id}.")
 
+def format_maintenance_report(report: dict) -> str:
+    mb = 1024 * 1024
+    lines = [
+        "🧹 <b>Обслуживание БД</b>" + (" (пробный запуск)" if report["dry_run"] else ""),
+        f"Размер БД: {report['db_bytes'] / mb:.1f} МБ, свободно внутри файла: {report['free_bytes'] / mb:.1f} МБ",
+        f"К архивации (старше {ARCHIVE_AFTER_DAYS} дн.): {report['archivable_messages']} сообщ., "
+        f"≈{report['archivable_bytes'] / mb:.1f} МБ данных",
+    ]
+    if not report["incremental_vacuum"]:
+        lines.append("Первое сжатие выполнит полный VACUUM (перевод в auto_vacuum=INCREMENTAL).")
+    if not report["dry_run"]:
+        lines.append(f"Перенесено в архив: {report['archived']}, освобождено: {report['reclaimed_bytes'] / mb:.1f} МБ")
+    return "\n".join(lines)
+
+
+async def run_maintenance(dry_run: bool = False) -> dict:
+    """Архивирует старые сообщения, сжимает файл БД и обновляет статистику. С dry_run только считает."""
+    cutoff = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+    report = await db.maintenance_report(cutoff)
+    report["dry_run"] = dry_run
+    if dry_run:
+        return report
+
+    archived = 0
+    if ARCHIVE_AFTER_DAYS:
+        while moved := await db.archive_messages(cutoff):
+            archived += moved
+            await asyncio.sleep(0)  # Между пачками успевают пройти обычные записи
+    report["archived"] = archived
+    report["reclaimed_bytes"] = await db.compact()
+    await db.optimize()
+    logging.info(f"Maintenance: archived {archived} messages, reclaimed {report['reclaimed_bytes']} bytes")
+    return report
+
+
+async def maintenance_task():
+    """Раз в сутки в MAINTENANCE_HOUR запускает обслуживание БД."""
+    while True:
+        now = datetime.now()
+        next_run = now.replace(hour=MAINTENANCE_HOUR, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            report = await run_maintenance(dry_run=MAINTENANCE_DRY_RUN)
+            if MAINTENANCE_DRY_RUN:
+                logging.info(f"Maintenance dry run: {report}")
         except Exception as e:
-            logging.error(f"Scheduler error: {e}")
+            logging.error(f"Maintenance failed: {e}")
 
 
-# --- Main Run ---
-async def main():
-    await db.create_tables()
+async def bot_identity_task():
+    """Периодически обновляет данные бота на случай смены username."""
+    while True:
+        await asyncio.sleep(BOT_INFO_REFRESH_INTERVAL)
+        try:
+            await bot_identity.refresh()
+        except Exception as e:
+            logging.error(f"getMe refresh failed: {e}")
+
+
+# --- Webhook Mode ---
+class LimitedRequestHandler(SimpleRequestHandler):
+    """Webhook-обработчик: не больше limit апдейтов обрабатывается одновременно, при остановке ждёт незавершённые."""
+
+    def __init__(self, *args, limit: int, **kwargs):
+        super().__init__(*args, handle_in_background=True, **kwargs)
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        # Пока все слоты заняты, не отвечаем Telegram — он сам придержит следующие апдейты
+        await self._semaphore.acquire()
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        task.add_done_callback(lambda _: self._semaphore.release())
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self):
+        pending = set(self._background_feed_update_tasks)
+        if pending:
+            logging.info(f"Waiting for {len(pending)} in-flight updates...")
+            await asyncio.wait(pending, timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+        # Сессию бота закрывает main()
+
+
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    await stop.wait()
+
+
+async def run_webhook(shards: Optional["ShardRouter"] = None):
+    """Принимает апдейты через aiohttp-сервер. Без WEBHOOK_URL вебхук в Telegram не регистрируется —
+    так удобно проверять бота локально, отправляя POST с записанными апдейтами на WEBHOOK_PATH.
+    С shards апдейты не обрабатываются здесь, а раздаются воркерам."""
+    secret = WEBHOOK_SECRET or (secrets.token_urlsafe(32) if WEBHOOK_URL else None)
+
+    app = web.Application()
+    if shards is not None:
+        app.router.add_post(WEBHOOK_PATH, shards.webhook_handler(secret))
+    else:
+        handler = LimitedRequestHandler(dispatcher=dp, bot=bot, secret_token=secret, limit=MAX_CONCURRENT_UPDATES)
+        handler.register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+        if METRICS_ENABLED and METRICS_PORT == WEBHOOK_PORT:
+            app.router.add_get("/metrics", metrics_handler)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=secret,
+                              max_connections=min(MAX_CONCURRENT_UPDATES, 100),
+                              allowed_updates=dp.resolve_used_update_types())
+
+    try:
+        await wait_for_stop_signal()
+    finally:
+        # on_shutdown приложения дожидается обработки уже принятых апдейтов
+        await runner.cleanup()
+
+
+# --- Sharded Mode ---
+service_queue = None  # В воркере-обработчике: очередь команд сервисному воркеру (доставка, планировщик, рассылки)
+
+
+async def schedule_message(msg_id: str, recipient_id: int, when: datetime):
+    """Передаёт сообщение планировщику — своему или, в шардированном режиме, сервисного воркера."""
+    if service_queue is None:
+        scheduler.push(msg_id, recipient_id, when)
+        return
+    await db.flush_writes()  # Сервисный воркер прочитает сообщение из БД
+    service_queue.put(("schedule", msg_id, recipient_id, when.isoformat()))
+
+
+def submit_delivery(msg_id: str, recipient_id: int):
+    """Передаёт сообщение (уже записанное в deliveries) очереди доставки — своей или сервисного воркера."""
+    if service_queue is None:
+        delivery_queue.push(msg_id, recipient_id, datetime.now())
+    else:
+        service_queue.put(("deliver", msg_id, recipient_id))
+
+
+def submit_broadcast(job: dict):
+    """Запускает рассылку здесь или, в шардированном режиме, в сервисном воркере."""
+    if service_queue is None:
+        start_broadcast_task(job)
+    else:
+        service_queue.put(("broadcast", job['job_id']))
+
+
+class ShardRouter:
+    """Раздаёт сырые апдейты (dict из JSON) воркерам по from_user.id: все апдейты одного пользователя
+    попадают в один процесс, поэтому его состояние FSM и кэши не расходятся между процессами."""
+
+    def __init__(self, queues: list):
+        self.queues = queues
+
+    @staticmethod
+    def user_id(update: dict) -> int:
+        for value in update.values():
+            if isinstance(value, dict):
+                sender = value.get("from") or value.get("user") or value.get("chat")
+                if isinstance(sender, dict) and "id" in sender:
+                    return sender["id"]
+        return 0
+
+    def route(self, update: dict):
+        self.queues[self.user_id(update) % len(self.queues)].put(update)
+
+    async def poll(self):
+        """getUpdates напрямую через aiohttp: супервизору не нужны модели aiogram, только from.id."""
+        url = bot.session.api.api_url(token=bot.token, method="getUpdates")
+        allowed = json.dumps(dp.resolve_used_update_types())
+        offset = None
+        async with ClientSession() as http:
+            while True:
+                params = {"timeout": 30, "allowed_updates": allowed}
+                if offset is not None:
+                    params["offset"] = offset
+                try:
+                    async with http.post(url, data=params, timeout=ClientTimeout(total=40)) as response:
+                        body = await response.json()
+                except (ClientError, asyncio.TimeoutError, ValueError) as e:
+                    logging.error(f"getUpdates failed: {e}")
+                    await asyncio.sleep(1)
+                    continue
+
+                if not body.get("ok"):
+                    logging.error(f"getUpdates error: {body.get('description')}")
+                    await asyncio.sleep((body.get("parameters") or {}).get("retry_after", 1))
+                    continue
+                for update in body["result"]:
+                    offset = update["update_id"] + 1
+                    self.route(update)
+
+    def webhook_handler(self, secret: Optional[str]):
+        async def handle(request: web.Request) -> web.Response:
+            if secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret:
+                return web.Response(status=401)
+            self.route(await request.json())
+            return web.json_response({})
+
+        return handle
+
+
+def run_worker(index: int, updates, commands, service: bool):
+    """Точка входа процесса-воркера. Ctrl+C и SIGTERM (systemd по умолчанию) получает вся группа процессов,
+    но останавливает воркер супервизор — после того как воркер допишет очереди записей и состояния FSM."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(worker_main(index, updates, commands, service))
+
 
+async def _feed_raw_update(update: dict):
+    try:
+        await dp.feed_raw_update(bot, update)
+    except Exception as e:
+        logging.exception(f"Update {update.get('update_id')} failed: {e}")
+
+
+async def worker_main(index: int, updates, commands, service: bool):
+    global service_queue
+    await db.connect()
+    db.channels_ttl = USER_CACHE_TTL  # Каналы добавляют и удаляют админы из других шардов
+    db.recipients_complete = False  # Ящики создают и другие шарды
+    await db.load_recipients()
+    await bot_identity.load()
+    dp["bot_identity"] = bot_identity
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    if isinstance(storage, SQLiteStorage):
+        storage.start()
+
+    metrics_runner = None
+    if METRICS_ENABLED:
+        setup_metrics()
+        metrics_runner = await start_metrics_server(METRICS_PORT + 1 + index)
+
+    loop = asyncio.get_running_loop()
+    background = [asyncio.create_task(bot_identity_task())]
+    try:
+        if service:
+            logging.info("Service worker started: deliveries, scheduler and broadcasts")
+            background.append(asyncio.create_task(delivery_task()))
+            background.append(asyncio.create_task(scheduler_task()))
+            background.append(asyncio.create_task(maintenance_task()))
+            await resume_broadcasts()
+            while (command := await loop.run_in_executor(None, commands.get)) is not None:
+                if command[0] == "deliver":
+                    delivery_queue.push(command[1], command[2], datetime.now())
+                elif command[0] == "schedule":
+                    _, msg_id, recipient_id, when = command
+                    scheduler.push(msg_id, recipient_id, datetime.fromisoformat(when))
+                elif command[0] == "broadcast":
+                    job = await db.get_broadcast(command[1])
+                    if job:
+                        start_broadcast_task(job)
+        else:
+            logging.info(f"Shard worker {index} started")
+            service_queue = commands
+            slots = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+            tasks = set()
+            while (update := await loop.run_in_executor(None, updates.get)) is not None:
+                await slots.acquire()
+                task = asyncio.create_task(_feed_raw_update(update))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: slots.release())
+            if tasks:
+                await asyncio.wait(tasks, timeout=WEBHOOK_SHUTDOWN_TIMEOUT)
+    finally:
+        for task in background + list(active_broadcasts):
+            task.cancel()  # Рассылки продолжатся с сохранённого курсора при следующем запуске
+        await asyncio.gather(*background, *active_broadcasts, return_exceptions=True)
+        await scheduler.stop()
+        await delivery_queue.stop()
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        await db.close()
+
+
+async def run_supervisor():
+    """Принимает апдейты (polling или вебхук) и раздаёт их воркерам; сам апдейты не обрабатывает."""
+    ctx = multiprocessing.get_context("spawn")  # fork копировал бы потоки aiosqlite и состояние event loop
+    commands = ctx.Queue()
+    update_queues = [ctx.Queue() for _ in range(SHARD_WORKERS)]
+    # Последний — сервисный воркер; перезапущенный воркер читает ту же очередь, что и упавший
+    slots = [(i, queue, False) for i, queue in enumerate(update_queues)] + [(SHARD_WORKERS, None, True)]
+
+    def spawn(index: int, queue, service: bool):
+        process = ctx.Process(target=run_worker, args=(index, queue, commands, service),
+                              name="service" if service else f"shard-{index}")
+        process.start()
+        return process
+
+    processes = [spawn(*slot) for slot in slots]
+
+    async def watch():
+        while True:
+            await asyncio.sleep(SHARD_WATCH_INTERVAL)
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    logging.error(f"Worker {process.name} died with exit code {process.exitcode}, restarting")
+                    processes[i] = spawn(*slots[i])
+
+    shards = ShardRouter(update_queues)
+    loop = asyncio.get_running_loop()
+    watcher = asyncio.create_task(watch())
+    logging.info(f"Supervisor started with {SHARD_WORKERS} shard workers")
+    try:
+        if USE_WEBHOOK:
+            await run_webhook(shards)
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.create_task(shards.poll())
+            try:
+                await wait_for_stop_signal()
+            finally:
+                poller.cancel()
+    finally:
+        watcher.cancel()  # Штатно завершившиеся воркеры не перезапускаем
+        *workers, service = processes
+        # Сначала обработчики (они ещё могут прислать команды сервисному воркеру), потом сервисный
+        for queue in update_queues:
+            queue.put(None)
+        for process in workers:
+            await loop.run_in_executor(None, process.join, SHARD_SHUTDOWN_TIMEOUT)
+        commands.put(None)
+        await loop.run_in_executor(None, service.join, SHARD_SHUTDOWN_TIMEOUT)
+        for process in processes:
+            if process.is_alive():
+                logging.warning(f"Worker {process.name} did not stop in time, killing")
+                process.kill()  # SIGTERM воркеры игнорируют
+
+
+# --- Main Run ---
+async def set_bot_commands():
     await bot.set_my_commands([
         BotCommand(command="start", description="Запустить бота"),
         BotCommand(command="send", description="Отправить сообщение"),
@@ -1239,13 +3327,60 @@ async def main():
         BotCommand(command="help", description="Помощь / FAQ"),
     ])
 
-    asyncio.create_task(scheduler_task())
+
+async def main():
+    await db.connect()
+    await db.create_tables()
+
+    if SHARD_WORKERS:
+        await db.close()  # Миграции выполнены; дальше с БД работают только воркеры
+        try:
+            await set_bot_commands()
+            await run_supervisor()
+        finally:
+            await bot.session.close()
+        return
+
+    if isinstance(storage, SQLiteStorage):
+        storage.start()
+    await db.load_recipients()
+    await bot_identity.load()
+    dp["bot_identity"] = bot_identity
+
+    await set_bot_commands()
+
+    metrics_runner = None
+    if METRICS_ENABLED:
+        setup_metrics()
+        if not (USE_WEBHOOK and METRICS_PORT == WEBHOOK_PORT):
+            metrics_runner = await start_metrics_server()
+
+    background = [
+        asyncio.create_task(delivery_task()),
+        asyncio.create_task(scheduler_task()),
+        asyncio.create_task(bot_identity_task()),
+        asyncio.create_task(maintenance_task()),
+    ]
+    await resume_broadcasts()
 
     logging.info("Бот запущен!")
     try:
-        await dp.start_polling(bot)
+        if USE_WEBHOOK:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot, tasks_concurrency_limit=MAX_CONCURRENT_UPDATES)
     finally:
+        for task in background + list(active_broadcasts):
+            task.cancel()  # Рассылки продолжатся с сохранённого курсора при следующем запуске
+        await asyncio.gather(*background, *active_broadcasts, return_exceptions=True)
+        await scheduler.stop()
+        await delivery_queue.stop()
+        await storage.close()  # Повторный вызов после on_shutdown безопасен: записывает то, что успело накопиться
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
         await bot.session.close()
+        await db.close()
 
 
 if __name__ == "__main__":
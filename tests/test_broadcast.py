@@ -0,0 +1,46 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+
+def test_broadcast_counters_update_before_batch_is_saved(tmp_path, monkeypatch):
+    release = asyncio.Event()
+    snapshots = []
+
+    async def copy_message(chat_id, from_chat_id, message_id):
+        if chat_id == 5:
+            await release.wait()  # Последний получатель пачки задерживается
+
+    async def edit_text(text):
+        pass
+
+    async def send_message(chat_id, text):
+        return SimpleNamespace(edit_text=edit_text)
+
+    monkeypatch.setattr(main.bot, "copy_message", copy_message)
+    monkeypatch.setattr(main.bot, "send_message", send_message)
+    monkeypatch.setattr(main, "telegram_limiter", main.TelegramRateLimiter(1000, 0))
+
+    async def go():
+        database = main.Database(str(tmp_path / "test.db"), readers=1)
+        await database.connect()
+        monkeypatch.setattr(main, "db", database)
+        try:
+            await database.create_tables()
+            for uid in range(1, 6):
+                await database.add_user(uid, f"user{uid}", "User")
+            broadcast = main.Broadcast(await database.create_broadcast(1, 1, 1))
+            task = asyncio.create_task(broadcast.run())
+            await asyncio.sleep(0.1)
+            job = await database.get_broadcast(broadcast.job_id)
+            snapshots.append((broadcast.delivered, job['delivered']))
+            release.set()
+            await task
+            job = await database.get_broadcast(broadcast.job_id)
+            snapshots.append((broadcast.delivered, job['delivered']))
+        finally:
+            await database.close()
+
+    asyncio.run(go())
+    assert snapshots == [(4, 0), (5, 5)]
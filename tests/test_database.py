@@ -0,0 +1,125 @@
+import asyncio
+
+import main
+
+
+def run_with_db(tmp_path, check):
+    async def go():
+        database = main.Database(str(tmp_path / "test.db"), readers=1)
+        await database.connect()
+        try:
+            await database.create_tables()
+            return await check(database)
+        finally:
+            await database.close()
+
+    return asyncio.run(go())
+
+
+def test_new_database_uses_incremental_auto_vacuum(tmp_path):
+    async def check(database):
+        async with database._read() as db:
+            return await database._pragma(db, "auto_vacuum")
+
+    assert run_with_db(tmp_path, check) == 2
+
+
+def test_undelivered_messages_are_not_archived(tmp_path):
+    async def check(database):
+        for msg_id, tg_message_id in (("delivered", 10), ("queued", 0), ("dead", 0), ("retried", 11)):
+            await database.save_message({
+                "msg_id": msg_id, "from_user_id": 1, "to_user_id": 2, "content_type": "text",
+                "content_text": "x", "file_id": None, "caption": None, "media": None,
+                "sent_at": "2000-01-01T00:00:00", "scheduled_time": None, "tg_message_id": tg_message_id,
+            })
+        await database.add_delivery("queued", 2, 1)
+        await database.add_delivery("dead", 2, 1)
+        await database.move_to_dead_letters("dead", "error")
+        await database.add_delivery("retried", 2, 1)  # Отправлено, но строка очереди ещё не удалена
+        await database.archive_messages("2001-01-01T00:00:00")
+        async with database._read() as db:
+            async with db.execute("SELECT msg_id FROM messages ORDER BY msg_id") as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    assert run_with_db(tmp_path, check) == ["dead", "queued", "retried"]
+
+
+def test_fsm_batch_survives_cancelled_flush(tmp_path):
+    async def check(database):
+        storage = main.SQLiteStorage(database)
+        key = main.StorageKey(bot_id=1, chat_id=2, user_id=2)
+        await storage.set_data(key, {"target_id": 5})
+
+        write_batch = storage._write_batch
+
+        async def slow_write_batch(batch):
+            await asyncio.sleep(10)
+            await write_batch(batch)
+
+        storage._write_batch = slow_write_batch
+        storage.start()
+        storage._wakeup.set()
+        await asyncio.sleep(0.05)  # Пачка уже забрана фоновой задачей и пишется
+        storage._write_batch = write_batch
+        await storage.close()
+        return await main.SQLiteStorage(database).get_data(key)
+
+    assert run_with_db(tmp_path, check) == {"target_id": 5}
+
+
+def test_query_plan_checker_ignores_subquery_scans():
+    plan = [
+        "CO-ROUTINE m",
+        "SEARCH messages USING INDEX sqlite_autoindex_messages_1 (msg_id=?)",
+        "SCAN m",
+        "SEARCH u USING INTEGER PRIMARY KEY (rowid=?) LEFT-JOIN",
+    ]
+    assert main.QueryPlanChecker.full_scans(plan) == []
+    assert main.QueryPlanChecker.full_scans(["MATERIALIZE t", "SCAN users", "SCAN t"]) == ["SCAN users"]
+
+
+def test_query_plan_checker_covers_executemany(tmp_path):
+    async def check(database):
+        database.check_query_plans = True
+        async with database._write() as db:
+            await db.executemany("UPDATE users SET banned = 1 WHERE username = ?", [("a",), ("b",)])
+        return database.get_full_scans()
+
+    assert list(run_with_db(tmp_path, check)) == ["UPDATE users SET banned = 1 WHERE username = ?"]
+
+
+def test_reserve_message_slot_stops_at_limit(tmp_path):
+    async def check(database):
+        await database.add_user(1, "user", "User")
+        return [await database.reserve_message_slot(1, 2) for _ in range(3)]
+
+    assert run_with_db(tmp_path, check) == [1, 2, None]
+
+
+def test_reserve_message_slot_resets_on_new_day(tmp_path):
+    async def check(database):
+        await database.add_user(1, "user", "User")
+        async with database._write() as db:
+            await db.execute("UPDATE users SET messages_sent_today = 5, last_message_date = '2000-01-01'")
+        return await database.reserve_message_slot(1, 5)
+
+    assert run_with_db(tmp_path, check) == 1
+
+
+def test_reserve_message_slot_without_limit(tmp_path):
+    async def check(database):
+        await database.add_user(1, "user", "User")
+        return [await database.reserve_message_slot(1, None) for _ in range(10)]
+
+    assert run_with_db(tmp_path, check) == list(range(1, 11))
+
+
+def test_concurrent_reservations_never_exceed_limit(tmp_path):
+    async def check(database):
+        await database.add_user(1, "user", "User")
+        slots = await asyncio.gather(*(database.reserve_message_slot(1, 5) for _ in range(20)))
+        return slots, (await database.get_user(1))["messages_sent_today"]
+
+    slots, sent_today = run_with_db(tmp_path, check)
+    assert sorted(slot for slot in slots if slot is not None) == [1, 2, 3, 4, 5]
+    assert slots.count(None) == 15 and sent_today == 5
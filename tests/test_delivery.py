@@ -0,0 +1,106 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import SendMessage
+
+import main
+
+
+def run_with_db(tmp_path, monkeypatch, check):
+    async def go():
+        database = main.Database(str(tmp_path / "test.db"), readers=1)
+        await database.connect()
+        monkeypatch.setattr(main, "db", database)
+        try:
+            await database.create_tables()
+            return await check(database)
+        finally:
+            await database.close()
+
+    monkeypatch.setattr(main, "telegram_limiter", main.TelegramRateLimiter(1000, 0))
+    return asyncio.run(go())
+
+
+def message_row(msg_id, content_type="text", **fields):
+    row = {
+        "msg_id": msg_id, "from_user_id": 1, "to_user_id": 2, "content_type": content_type,
+        "content_text": "x", "file_id": None, "caption": None, "media": None,
+        "sent_at": "2000-01-01T00:00:00", "scheduled_time": None, "tg_message_id": 0,
+    }
+    row.update(fields)
+    return row
+
+
+def test_scheduler_stop_cancels_inflight_deliveries():
+    class SlowScheduler(main.MessageScheduler):
+        def __init__(self):
+            super().__init__()
+            self.started = []
+
+        async def _deliver(self, msg_id, recipient_id):
+            self.started.append(msg_id)
+            await asyncio.sleep(10)
+
+    async def go():
+        scheduler = SlowScheduler()
+        scheduler._dispatch("a", 1)
+        scheduler._dispatch("b", 2)
+        await asyncio.sleep(0.01)
+        await scheduler.stop()
+        return scheduler.started, scheduler._tasks, scheduler._recipients
+
+    started, tasks, recipients = asyncio.run(go())
+    assert sorted(started) == ["a", "b"]
+    assert not tasks and not recipients
+
+
+def test_album_retry_resends_only_the_keyboard(tmp_path, monkeypatch):
+    calls = []
+
+    async def send_album(msg, recipient_id):
+        calls.append("album")
+        return 77
+
+    async def send_album_keyboard(msg, recipient_id, album_message_id):
+        calls.append(("keyboard", album_message_id))
+        if len(calls) == 2:
+            raise TelegramNetworkError(SendMessage(chat_id=recipient_id, text=""), "Request timeout")
+        return SimpleNamespace(message_id=78)
+
+    async def notify(chat_id, text):
+        pass
+
+    monkeypatch.setattr(main, "send_album", send_album)
+    monkeypatch.setattr(main, "send_album_keyboard", send_album_keyboard)
+    monkeypatch.setattr(main.DeliveryQueue, "_notify", staticmethod(notify))
+
+    async def check(database):
+        await database.save_message(message_row("album", main.MEDIA_GROUP, media="[]"))
+        await database.add_delivery("album", 2, 1)
+        queue = main.DeliveryQueue()
+        await queue._deliver("album", 2)  # Альбом ушёл, кнопки — нет: повтор назначен
+        await queue._deliver("album", 2)
+        await database.flush_writes()
+        return await database.get_delivery("album"), await database.get_message("album")
+
+    delivery, message = run_with_db(tmp_path, monkeypatch, check)
+    assert calls == ["album", ("keyboard", 77), ("keyboard", 77)]
+    assert delivery is None and message["tg_message_id"] == 78
+
+
+def test_due_scheduled_message_goes_through_the_delivery_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "delivery_queue", main.DeliveryQueue())
+
+    async def check(database):
+        await database.save_message(message_row("later", scheduled_time="2000-01-01T00:00:00", from_user_id=7))
+        await database.flush_writes()
+        pending_before = await database.get_pending_schedule()
+        await main.MessageScheduler()._deliver("later", 2)
+        return pending_before, await database.get_delivery("later"), await database.get_pending_schedule()
+
+    pending_before, delivery, pending_after = run_with_db(tmp_path, monkeypatch, check)
+    assert [row[0] for row in pending_before] == ["later"]
+    assert delivery["recipient_id"] == 2 and delivery["sender_chat_id"] == 7
+    assert pending_after == []  # После перезапуска сообщение догрузит только очередь доставки
+    assert len(main.delivery_queue) == 1
@@ -0,0 +1,85 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+import import_legacy
+import main
+
+LEGACY = {
+    "users": {
+        "100": {"username": "alice", "full_name": "Алиса \"А\" \\ ☃", "is_admin": True, "reg_date": "2024-01-01"},
+        "200": {"username": None, "first_name": "Bob", "banned": False},
+    },
+    "recipients": {"100": {"code": "ABC123", "username": "alice"}, "300": {"code": "XYZ789", "first_name": "Eve"}},
+    "messages": {
+        "m1": {"from_user_id": 300, "to_user_id": 100, "content_type": "text", "content_text": "привет, 1e5",
+               "sent_at": "2024-01-02T10:00:00", "tg_message_id": 1234567890123},
+        "m2": {"from_user_id": 200, "to_user_id": 100, "content_type": "photo", "caption": None,
+               "content": {"photo": [{"file_id": "small"}, {"file_id": "big"}]}, "revealed": 1},
+    },
+    "required_channels": {"-1001234567890": "https://t.me/+abc", "-100987": {"title": "News", "link": "x"}},
+    "version": -12.5e-3,
+    "empty": {},
+    "tags": [1, 22, 333, [4444, {"k": "v"}], True, None],
+}
+
+
+def read_document(stream):
+    result = {}
+    for section in stream.keys():
+        if section in ("users", "recipients", "messages", "required_channels", "empty"):
+            result[section] = dict(stream.items())
+        else:
+            result[section] = stream.value()
+    return result
+
+
+@pytest.mark.parametrize("indent", [None, 2])
+def test_json_stream_matches_json_loads_at_tiny_chunk_sizes(indent):
+    text = json.dumps(LEGACY, ensure_ascii=False, indent=indent)
+    for chunk_size in range(1, 41):
+        stream = import_legacy.JsonStream(io.StringIO(text), chunk_size=chunk_size)
+        assert read_document(stream) == json.loads(text), chunk_size
+
+
+def test_json_stream_rejects_truncated_document():
+    text = json.dumps(LEGACY)[:-10]
+    with pytest.raises(ValueError):
+        read_document(import_legacy.JsonStream(io.StringIO(text), chunk_size=7))
+
+
+def test_import_is_idempotent(tmp_path):
+    path = tmp_path / "bot_data.json"
+    path.write_text(json.dumps(LEGACY, ensure_ascii=False), encoding="utf-8")
+
+    async def snapshot(database):
+        tables = {}
+        async with database._read() as db:
+            for table in ("users", "recipients", "messages", "channels"):
+                async with db.execute(f"SELECT * FROM {table} ORDER BY 1") as cursor:
+                    tables[table] = [tuple(row) for row in await cursor.fetchall()]
+        return tables
+
+    async def go():
+        database = main.Database(str(tmp_path / "test.db"), readers=1)
+        await database.connect()
+        try:
+            await database.create_tables()
+            runs = []
+            for _ in range(2):
+                importer = import_legacy.LegacyImporter(database, batch_size=2)
+                with open(path, encoding="utf-8") as f:
+                    await importer.run(f)
+                runs.append((importer.inserted, await snapshot(database)))
+            return runs
+        finally:
+            await database.close()
+
+    (first_inserted, first), (second_inserted, second) = asyncio.run(go())
+    tables = ("users", "recipients", "messages", "channels")
+    assert [first_inserted.get(table) for table in tables] == [3, 2, 2, 2]
+    assert [second_inserted.get(table) for table in tables] == [0, 0, 0, 0]
+    assert second == first
+    assert [row[0] for row in first["users"]] == [100, 200, 300]
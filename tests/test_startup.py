@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter, TelegramUnauthorizedError
+from aiogram.methods import GetMe
+from aiogram.types import User
+
+import main
+
+ME = User(id=1, is_bot=True, first_name="Bot", username="anon_bot")
+
+
+def fake_get_me(errors):
+    async def get_me():
+        if errors:
+            raise errors.pop(0)
+        return ME
+
+    return get_me
+
+
+def test_bot_identity_load_retries_transient_errors(monkeypatch):
+    errors = [TelegramRetryAfter(GetMe(), "Too Many Requests", retry_after=0) for _ in range(2)]
+    monkeypatch.setattr(main.bot, "get_me", fake_get_me(errors))
+    identity = main.BotIdentity()
+    asyncio.run(identity.load())
+    assert identity.username == "anon_bot"
+
+
+def test_bot_identity_load_does_not_retry_unauthorized(monkeypatch):
+    errors = [TelegramUnauthorizedError(GetMe(), "Unauthorized"), None]
+    monkeypatch.setattr(main.bot, "get_me", fake_get_me(errors))
+    with pytest.raises(TelegramUnauthorizedError):
+        asyncio.run(main.BotIdentity().load())